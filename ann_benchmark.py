@@ -0,0 +1,69 @@
+import time
+import numpy as np
+from ann_index import IVFPQIndex
+from evaluation_faces_with_masks import nearest_neighbors
+
+
+def fake_embeddings(num,num_ids,embed_length,noise,rng):
+    '''
+    L2-normalized embeddings clustered by identity like the face embeddings
+    :return: embeddings [num, embed_length], identity of each embedding [num], identity centers
+    '''
+    centers = rng.normal(0, 1, [num_ids, embed_length]).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    labels = rng.randint(0, num_ids, num)
+    embeddings = centers[labels] + rng.normal(0, noise, [num, embed_length]).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    return embeddings, labels, centers
+
+def ann_benchmark(gallery_size=200000,query_size=500,embed_length=128,n_list=1024,m=16,nprobe_list=(1,4,8,16,32),
+                  rerank_list=(0,100),k=10,noise=0.05):
+    '''
+    recall and latency of IVFPQIndex vs the exhaustive search(nearest_neighbors) on fake embeddings.
+    recall@1: ratio of the exact nearest one found as the first one, recall@k: ratio of the exact k nearest ones found
+    :param gallery_size: embeddings in the index
+    :param query_size: queries, each one is another sample of an identity of the gallery
+    :param nprobe_list: lists scanned of each query
+    :param rerank_list: candidates re-ranked by the exact distances, 0: no re-ranking
+    :param k: neighbors of each query
+    :param noise: the std of the embeddings of an identity before normalization
+    :return:
+    '''
+    # ----var
+    rng = np.random.RandomState(0)
+    num_ids = max(gallery_size // 10, 1)
+
+    gallery, _, centers = fake_embeddings(gallery_size, num_ids, embed_length, noise, rng)
+    queries = centers[rng.randint(0, num_ids, query_size)] + rng.normal(0, noise, [query_size, embed_length])
+    queries = (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+
+    # ----exhaustive search
+    d_t = time.time()
+    indices_exact, _ = nearest_neighbors(queries, gallery, k=k)
+    d_t_exact = (time.time() - d_t) / query_size
+    print("gallery:{}, queries:{}, exhaustive search time:{:.6f}s".format(gallery_size, query_size, d_t_exact))
+
+    # ----index building
+    d_t = time.time()
+    index = IVFPQIndex(n_list=n_list, m=m)
+    index.build(gallery)
+    print("n_list:{}, m:{}, build time:{:.2f}s, code size:{}MB(embeddings:{}MB)".format(
+        n_list, m, time.time() - d_t, index.codes.nbytes // 2 ** 20, gallery.nbytes // 2 ** 20))
+
+    for rerank in rerank_list:
+        for nprobe in nprobe_list:
+            d_t = time.time()
+            indices, _ = index.search(queries, k=k, nprobe=nprobe, rerank=rerank)
+            d_t_ann = (time.time() - d_t) / query_size
+
+            recall_1 = np.mean(indices[:, 0] == indices_exact[:, 0])
+            recall_k = np.mean([len(np.intersect1d(a, b)) / k for a, b in zip(indices, indices_exact)])
+            print("rerank:{}, nprobe:{}, recall@1:{:.4f}, recall@{}:{:.4f}, time:{:.6f}s, speedup:{:.2f}".format(
+                rerank, nprobe, recall_1, k, recall_k, d_t_ann, d_t_exact / d_t_ann))
+
+
+
+if __name__ == "__main__":
+    ann_benchmark(gallery_size=200000, query_size=500, embed_length=128, n_list=1024, m=16,
+                  nprobe_list=(1,4,8,16,32), rerank_list=(0,100), k=10)
@@ -0,0 +1,244 @@
+import os
+import numpy as np
+
+
+def assign_nearest(data,centroids,chunk_size=4096):
+    '''
+    index of the nearest centroid of each row by euclidean distance, chunk by chunk of rows
+    :param data: numpy array, [N, d]
+    :param centroids: numpy array, [k, d]
+    :return: numpy array, [N], int64
+    '''
+    sq_norm = np.sum(np.square(centroids), axis=1)
+    assign = np.zeros(data.shape[0], dtype=np.int64)
+    for num_start in range(0, data.shape[0], chunk_size):
+        num_end = min(num_start + chunk_size, data.shape[0])
+        distance = np.dot(data[num_start:num_end], centroids.T)#|x|^2 is the same in a row, it's skipped
+        distance *= -2
+        distance += sq_norm[None, :]
+        assign[num_start:num_end] = np.argmin(distance, axis=1)
+
+    return assign
+
+def kmeans(data,k,n_iter=20,rng=None):
+    '''
+    Lloyd's k-means, the empty clusters are re-seeded with random rows
+    :param data: numpy array, [N, d], float32
+    :param k: number of clusters, k <= N
+    :param rng: numpy RandomState
+    :return: centroids [k, d]
+    '''
+    if rng is None:
+        rng = np.random.RandomState(0)
+    centroids = data[rng.choice(data.shape[0], k, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assign = assign_nearest(data, centroids)
+        counts = np.bincount(assign, minlength=k)
+        for i in range(data.shape[1]):
+            centroids[:, i] = np.bincount(assign, weights=data[:, i], minlength=k)
+        empty = counts == 0
+        centroids[~empty] /= counts[~empty, None]
+        if np.any(empty):
+            centroids[empty] = data[rng.choice(data.shape[0], int(np.sum(empty)), replace=False)]
+
+    return centroids
+
+
+class IVFPQIndex():
+    def __init__(self,n_list=1024,m=16,ksub=256,n_iter=20,train_size=100000,nprobe=8,rerank=0,seed=0):
+        '''
+        approximate nearest neighbor index of embeddings(IVF-PQ).
+        The coarse k-means splits the embeddings into n_list inverted lists, the residual of each embedding to its
+        list centroid is product quantized into m codes of 1 byte. A search scans the nprobe nearest lists only and
+        scores them with the look-up tables of the codes, the top candidates can be re-ranked by the exact distances
+        :param n_list: number of inverted lists(coarse centroids), about sqrt(N) to 4 * sqrt(N)
+        :param m: number of sub-vectors, the embedding length must be divisible by m
+        :param ksub: centroids of each sub-vector, <= 256(uint8 codes)
+        :param n_iter: k-means iterations
+        :param train_size: embeddings sampled to train k-means
+        :param nprobe: default lists scanned of each query, the higher the better recall and the slower
+        :param rerank: default candidates re-ranked by the exact distances, 0: no re-ranking
+        '''
+        if ksub > 256:
+            raise ValueError("ksub must be <= 256, the codes are uint8")
+
+        # ----local var to global
+        self.n_list = n_list
+        self.m = m
+        self.ksub = ksub
+        self.n_iter = n_iter
+        self.train_size = train_size
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.seed = seed
+        self.centroids = None#[n_list, d]
+        self.codebooks = None#[m, ksub, d / m]
+        self.codes = None#[N, m], sorted by list
+        self.ids = None#[N], the embedding index of each code row
+        self.list_offsets = None#[n_list + 1], the code rows of list i: list_offsets[i]:list_offsets[i + 1]
+        self.vectors = None#the embeddings for re-ranking
+        self.count = 0
+
+    def build(self,embeddings):
+        '''
+        :param embeddings: numpy array or memmap, [N, d], it's kept(not copied) for re-ranking
+        '''
+        # ----var
+        rng = np.random.RandomState(self.seed)
+        count, d = embeddings.shape
+        if d % self.m != 0:
+            raise ValueError("the embedding length {} is not divisible by m={}".format(d, self.m))
+        dsub = d // self.m
+
+        # ----coarse quantizer, trained on a sample
+        if count > self.train_size:
+            sample = np.asarray(embeddings[np.sort(rng.choice(count, self.train_size, replace=False))],
+                                dtype=np.float32)
+        else:
+            sample = np.asarray(embeddings, dtype=np.float32)
+        n_list = min(self.n_list, sample.shape[0])
+        ksub = min(self.ksub, sample.shape[0])
+        centroids = kmeans(sample, n_list, n_iter=self.n_iter, rng=rng)
+
+        # ----product quantizer of the residuals, 100 samples per centroid are enough for the small sub-vectors
+        residual = sample - centroids[assign_nearest(sample, centroids)]
+        if residual.shape[0] > ksub * 100:
+            residual = residual[rng.choice(residual.shape[0], ksub * 100, replace=False)]
+        codebooks = np.zeros([self.m, ksub, dsub], dtype=np.float32)
+        for j in range(self.m):
+            codebooks[j] = kmeans(np.ascontiguousarray(residual[:, j * dsub:(j + 1) * dsub]), ksub,
+                                  n_iter=self.n_iter, rng=rng)
+
+        # ----encode all embeddings chunk by chunk
+        assign = np.zeros(count, dtype=np.int64)
+        codes = np.zeros([count, self.m], dtype=np.uint8)
+        chunk_size = 65536
+        for num_start in range(0, count, chunk_size):
+            num_end = min(num_start + chunk_size, count)
+            chunk = np.asarray(embeddings[num_start:num_end], dtype=np.float32)
+            assign[num_start:num_end] = assign_nearest(chunk, centroids)
+            residual = chunk - centroids[assign[num_start:num_end]]
+            for j in range(self.m):
+                codes[num_start:num_end, j] = assign_nearest(residual[:, j * dsub:(j + 1) * dsub], codebooks[j])
+
+        # ----inverted lists: code rows sorted by list
+        ids = np.argsort(assign, kind='stable')
+        list_offsets = np.searchsorted(assign[ids], np.arange(n_list + 1))
+
+        # ----local var to global
+        self.centroids = centroids
+        self.codebooks = codebooks
+        self.codes = codes[ids]
+        self.ids = ids
+        self.list_offsets = list_offsets
+        self.vectors = embeddings
+        self.count = count
+
+    def search(self,queries,k=1,nprobe=None,rerank=None):
+        '''
+        :param queries: numpy array, [Q, d]
+        :param k: neighbors of each query
+        :param nprobe: lists scanned of each query, None: self.nprobe
+        :param rerank: candidates re-ranked by the exact distances(needs self.vectors), None: self.rerank
+        :return: indices [Q, k] and euclidean distances [Q, k], sorted by distance,
+                 -1 and inf if fewer than k candidates are found
+        '''
+        # ----var
+        if nprobe is None:
+            nprobe = self.nprobe
+        if rerank is None:
+            rerank = self.rerank
+        if self.vectors is None:
+            rerank = 0
+        queries = np.asarray(queries, dtype=np.float32)
+        n_list = self.centroids.shape[0]
+        nprobe = min(nprobe, n_list)
+        ksub, dsub = self.codebooks.shape[1:]
+        n_keep = max(k, rerank)
+        indices = np.full([queries.shape[0], k], -1, dtype=np.int64)
+        distances = np.full([queries.shape[0], k], np.inf, dtype=np.float32)
+        codebook_norms = np.sum(np.square(self.codebooks), axis=2)#[m, ksub]
+        sub_offsets = np.arange(self.m) * ksub
+
+        # ----the nearest lists of all queries
+        coarse = np.dot(queries, self.centroids.T)
+        coarse *= -2
+        coarse += np.sum(np.square(self.centroids), axis=1)[None, :]
+        if nprobe < n_list:
+            probes = np.argpartition(coarse, nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            probes = np.tile(np.arange(n_list), (queries.shape[0], 1))
+
+        for idx, query in enumerate(queries):
+            lists = probes[idx]
+            starts = self.list_offsets[lists]
+            sizes = self.list_offsets[lists + 1] - starts
+            n_cand = int(np.sum(sizes))
+            if n_cand == 0:
+                continue
+
+            # ----look-up tables of the residuals to the probed centroids, [nprobe, m, ksub]
+            residual = (query[None, :] - self.centroids[lists]).reshape(nprobe, self.m, dsub)
+            lut = np.einsum('pmd,mkd->pmk', residual, self.codebooks)
+            lut *= -2
+            lut += codebook_norms[None]
+            lut += np.sum(np.square(residual), axis=2)[:, :, None]
+
+            # ----approximate distances of the candidates
+            rows = np.repeat(starts - np.cumsum(sizes) + sizes, sizes) + np.arange(n_cand)
+            lut_offsets = np.repeat(np.arange(nprobe) * (self.m * ksub), sizes)
+            approx = np.take(lut, self.codes[rows] + (lut_offsets[:, None] + sub_offsets[None, :])).sum(axis=1)
+            if n_keep < n_cand:
+                top = np.argpartition(approx, n_keep - 1)[:n_keep]
+            else:
+                top = np.arange(n_cand)
+            cand_ids = self.ids[rows[top]]
+            cand_dis = approx[top]
+
+            # ----exact re-ranking
+            if rerank > 0:
+                cand_vectors = np.asarray(self.vectors[np.sort(cand_ids)], dtype=np.float32)
+                cand_ids = np.sort(cand_ids)
+                cand_dis = np.sum(np.square(cand_vectors - query[None, :]), axis=1)
+
+            order = np.argsort(cand_dis)[:k]
+            indices[idx, :len(order)] = cand_ids[order]
+            distances[idx, :len(order)] = cand_dis[order]
+
+        np.maximum(distances, 0, out=distances)#rounding errors of the look-up tables
+
+        return indices, np.sqrt(distances)
+
+    def save(self,save_path,source=None):
+        '''
+        the vectors aren't saved, set self.vectors after load_ivfpq() for re-ranking
+        :param source: str of what the index is built from(e.g. the gallery file state), kept for checking staleness
+        '''
+        tmp_path = save_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, codebooks=self.codebooks, codes=self.codes, ids=self.ids,
+                     list_offsets=self.list_offsets,
+                     para=np.array([self.n_list, self.m, self.ksub, self.n_iter, self.train_size, self.nprobe,
+                                    self.rerank, self.seed, self.count], dtype=np.int64),
+                     source=np.array("" if source is None else source))
+        os.replace(tmp_path, save_path)
+
+
+def load_ivfpq(save_path):
+    '''
+    :return: IVFPQIndex and the source str given to save()
+    '''
+    with np.load(save_path) as npz:
+        n_list, m, ksub, n_iter, train_size, nprobe, rerank, seed, count = [int(v) for v in npz['para']]
+        index = IVFPQIndex(n_list=n_list, m=m, ksub=ksub, n_iter=n_iter, train_size=train_size, nprobe=nprobe,
+                           rerank=rerank, seed=seed)
+        index.centroids = npz['centroids']
+        index.codebooks = npz['codebooks']
+        index.codes = npz['codes']
+        index.ids = npz['ids']
+        index.list_offsets = npz['list_offsets']
+        index.count = count
+        source = str(npz['source'])
+
+    return index, source
@@ -0,0 +1,73 @@
+import time, cv2
+import numpy as np
+from mask_wear_class import MaskAssetCache, composite
+
+
+def blend_benchmark(mask_img_dir,roi_sizes=((64,40),(112,80),(224,160)),batch_size=64,repeat=20,which=0):
+    '''
+    compare the cv2 sequence of mask_wearing(bitwise_and with the inverse mask, add, copy back) with composite,
+    ROI by ROI and a batch of same-size ROIs at once. The face mask variants are precomputed in both ways.
+    :param mask_img_dir: dir of face mask PNG images
+    :param roi_sizes: (width,height) of the mouth parts
+    :param batch_size: images of each run
+    :param repeat: runs of each ROI size
+    :param which: index of the face mask
+    :return:
+    '''
+    # ----var
+    rng = np.random.RandomState(0)
+    mask_cache = MaskAssetCache(mask_img_dir, size_step=1)
+    if mask_cache.mask_num == 0:
+        print("Error: no face mask PNG images in  ", mask_img_dir)
+        return
+
+    for width, height in roi_sizes:
+        img_item, item_mask, item_img_bgr, item_alpha = mask_cache.get(which, (width, height))
+        item_mask_inv = cv2.bitwise_not(item_mask)
+        imgs = rng.randint(0, 256, [batch_size, height * 2, width * 2, 3]).astype(np.uint8)
+        y_min, x_min = height // 2, width // 2
+
+        # ----cv2 sequence
+        imgs_cv2 = imgs.copy()
+        d_t = time.time()
+        for _ in range(repeat):
+            for img in imgs_cv2:
+                roi = img[y_min:y_min + height, x_min:x_min + width]
+                roi = cv2.bitwise_and(roi, roi, mask=item_mask_inv)
+                img[y_min:y_min + height, x_min:x_min + width] = cv2.add(roi, img_item)
+        d_t_cv2 = (time.time() - d_t) / (repeat * batch_size)
+
+        # ----composite, ROI by ROI
+        imgs_single = imgs.copy()
+        d_t = time.time()
+        for _ in range(repeat):
+            for img in imgs_single:
+                composite(img[y_min:y_min + height, x_min:x_min + width], img_item, item_mask)
+        d_t_single = (time.time() - d_t) / (repeat * batch_size)
+
+        # ----composite, the batch at once
+        imgs_batch = imgs.copy()
+        d_t = time.time()
+        for _ in range(repeat):
+            composite(imgs_batch[:, y_min:y_min + height, x_min:x_min + width], img_item, item_mask)
+        d_t_batch = (time.time() - d_t) / (repeat * batch_size)
+
+        # ----composite with alpha blending
+        imgs_alpha = imgs.copy()
+        d_t = time.time()
+        for _ in range(repeat):
+            composite(imgs_alpha[:, y_min:y_min + height, x_min:x_min + width], item_img_bgr, item_mask,
+                      alpha=item_alpha)
+        d_t_alpha = (time.time() - d_t) / (repeat * batch_size)
+
+        same = np.array_equal(imgs_cv2, imgs_single) and np.array_equal(imgs_cv2, imgs_batch)
+        print("ROI size:{}x{}, same results:{}".format(width, height, same))
+        print("    cv2 sequence:{:.6f}s, composite:{:.6f}s(speedup:{:.2f}), batch composite:{:.6f}s(speedup:{:.2f}), "
+              "batch alpha blending:{:.6f}s".format(d_t_cv2, d_t_single, d_t_cv2 / d_t_single, d_t_batch,
+                                                    d_t_cv2 / d_t_batch, d_t_alpha))
+
+
+
+if __name__ == "__main__":
+    mask_img_dir = r"mask_img"
+    blend_benchmark(mask_img_dir, roi_sizes=((64,40),(112,80),(224,160)), batch_size=64, repeat=20)
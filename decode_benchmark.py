@@ -0,0 +1,71 @@
+import time
+import numpy as np
+from face_alignment import FaceMaskDetection
+
+
+def decode_benchmark(pb_path,conf_thresh_list=(0.8,0.5,0.2),batch_size=8,repeat=20,GPU_ratio=None):
+    '''
+    compare decoding all anchors(decode_bbox) with decoding the anchors passing conf_thresh only(select_decode).
+    The decode time covers the decoding(and the score filtering of the selected way), the total time adds
+    post_process(NMS and box scaling) which filters the scores of all anchors again in the first way.
+    :param pb_path: face mask detection pb file, only used to get the anchors
+    :param conf_thresh_list: the higher conf_thresh, the less anchors are decoded
+    :param batch_size: images of each run
+    :param repeat: runs of each conf_thresh
+    :param GPU_ratio:
+    :return:
+    '''
+    # ----var
+    rng = np.random.RandomState(0)
+    ori_height, ori_width = 480, 640
+
+    fmd = FaceMaskDetection(pb_path, GPU_ratio=GPU_ratio)
+    anchor_num = fmd.anchors_exp.shape[1]
+    print("anchor number:", anchor_num)
+
+    # ----fake model outputs of a batch, most anchors are background like the real outputs
+    raw_outputs = rng.normal(0, 1, [batch_size, anchor_num, 4]).astype(np.float32)
+    y_cls_output = np.zeros([batch_size, anchor_num, 2], dtype=np.float32)
+    y_cls_output[:, :, 0] = rng.beta(0.5, 5, [batch_size, anchor_num])
+    y_cls_output[:, :, 1] = 1 - y_cls_output[:, :, 0]
+    y_cls_output = np.minimum(y_cls_output, rng.beta(0.5, 5, [batch_size, anchor_num, 1]) * 2)
+
+    for conf_thresh in conf_thresh_list:
+        fmd.conf_thresh = conf_thresh
+        candidates = np.sum(np.max(y_cls_output, axis=-1) > conf_thresh) / batch_size
+
+        # ----decode all anchors
+        d_t_decode_all = 0
+        d_t = time.time()
+        for _ in range(repeat):
+            d_t_2 = time.time()
+            y_bboxes_batch = fmd.decode_bbox(fmd.anchors_exp, raw_outputs)
+            d_t_decode_all += time.time() - d_t_2
+            results_all = [fmd.post_process(y_bboxes, y_cls, ori_height, ori_width)
+                           for y_bboxes, y_cls in zip(y_bboxes_batch, y_cls_output)]
+        d_t_all = (time.time() - d_t) / (repeat * batch_size)
+        d_t_decode_all /= repeat * batch_size
+
+        # ----decode the anchors passing conf_thresh
+        d_t_decode_selected = 0
+        d_t = time.time()
+        for _ in range(repeat):
+            d_t_2 = time.time()
+            selected = fmd.select_decode(raw_outputs, y_cls_output, conf_thresh)
+            d_t_decode_selected += time.time() - d_t_2
+            results_selected = [fmd.post_process(y_bboxes, y_cls, ori_height, ori_width)
+                                for y_bboxes, y_cls in selected]
+        d_t_selected = (time.time() - d_t) / (repeat * batch_size)
+        d_t_decode_selected /= repeat * batch_size
+
+        same = all([r_all[0] == r_sel[0] and r_all[1] == r_sel[1] for r_all, r_sel in zip(results_all, results_selected)])
+        print("conf_thresh:{}, candidates:{}, same results:{}".format(conf_thresh, candidates, same))
+        print("    decode time, all:{:.6f}s, selected:{:.6f}s".format(d_t_decode_all, d_t_decode_selected))
+        print("    total time, all:{:.6f}s, selected:{:.6f}s, speedup:{:.2f}".format(d_t_all, d_t_selected,
+                                                                                 d_t_all / d_t_selected))
+
+
+
+if __name__ == "__main__":
+    pb_path = r'face_mask_detection.pb'
+    decode_benchmark(pb_path, conf_thresh_list=(0.8,0.5,0.2), batch_size=8, repeat=20)
@@ -0,0 +1,447 @@
+import os, math, cv2, queue, threading, hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tensorflow
+
+#----tensorflow version check
+if tensorflow.__version__.startswith('1.'):
+    import tensorflow as tf
+    from tensorflow.python.platform import gfile
+else:
+    import tensorflow.compat.v1 as tf
+    tf.disable_v2_behavior()
+    import tensorflow.compat.v1.gfile as gfile
+print("Tensorflow version: ",tf.__version__)
+
+
+img_format = {'png', 'jpg', 'bmp'}
+
+
+def model_restore_from_pb(pb_path,node_dict,GPU_ratio=None,input_shape=None,intra_threads=0,inter_threads=0):
+    '''
+    restore the model from the pb file, the only copy shared by all scripts
+    :param node_dict: dict of key to tensor name, the keys not in the graph are skipped
+    :param GPU_ratio: None: allow growth, else the ratio of GPU memory
+    :param input_shape: [N,H,W,C], if it is given, the input node of node_dict is replaced by a new placeholder
+                        with this shape(the graph must not depend on the original input size)
+    :param intra_threads: threads of one op(0: tf default, the number of cores)
+    :param inter_threads: threads of running independent ops(0: tf default)
+    :return: sess, dict of key to tensor
+    '''
+    tf_dict = dict()
+    with tf.Graph().as_default():
+        config = tf.ConfigProto(allow_soft_placement=True,#allow tf to use alternative devices
+                                intra_op_parallelism_threads=intra_threads,
+                                inter_op_parallelism_threads=inter_threads)
+        if GPU_ratio is None:
+            config.gpu_options.allow_growth = True
+        else:
+            config.gpu_options.per_process_gpu_memory_fraction = GPU_ratio
+        sess = tf.Session(config=config)
+        with gfile.FastGFile(pb_path, 'rb') as f:
+            graph_def = tf.GraphDef()
+            graph_def.ParseFromString(f.read())
+            sess.graph.as_default()
+
+            #----issue solution if models with batch norm
+            '''
+            ValueError: Input 0 of node InceptionResnetV2/Conv2d_1a_3x3/BatchNorm/cond_1/AssignMovingAvg/Switch was passed
+            float from InceptionResnetV2/Conv2d_1a_3x3/BatchNorm/moving_mean:0 incompatible with expected float_ref.
+            ref:https://blog.csdn.net/dreamFlyWhere/article/details/83023256
+            '''
+            for node in graph_def.node:
+                if node.op == 'RefSwitch':
+                    node.op = 'Switch'
+                    for index in range(len(node.input)):
+                        if 'moving_' in node.input[index]:
+                            node.input[index] = node.input[index] + '/read'
+                elif node.op == 'AssignSub':
+                    node.op = 'Sub'
+                    if 'use_locking' in node.attr: del node.attr['use_locking']
+
+            if input_shape is None:
+                tf.import_graph_def(graph_def, name='')
+            else:
+                tf_input = tf.placeholder(tf.float32, shape=input_shape, name='input_reshaped')
+                tf.import_graph_def(graph_def, name='', input_map={node_dict['input']: tf_input})
+
+        sess.run(tf.global_variables_initializer())
+        for key, value in node_dict.items():
+            try:
+                node = sess.graph.get_tensor_by_name(value)
+                tf_dict[key] = node
+            except:
+                print("node:{} does not exist in the graph".format(key))
+        if input_shape is not None:
+            tf_dict['input'] = tf_input
+
+        return sess, tf_dict
+
+
+def pb_fingerprint(pb_path,chunk_size=1 << 20):
+    '''
+    :return: sha1 hex digest of the pb file, embeddings of another pb(even the same path retrained) never match it
+    '''
+    sha1 = hashlib.sha1()
+    with open(pb_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+def file_stat(path):
+    '''
+    :return: (size, mtime(ns)) of the file, (None, None) if it doesn't exist
+    '''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None, None
+
+    return stat.st_size, stat.st_mtime_ns
+
+def lock_file(f):
+    '''
+    exclusive lock of an open file without waiting, it's released when the file is closed or the process ends
+    :return: True if it's locked, False if another process holds it
+    '''
+    try:
+        try:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except ImportError:
+            import msvcrt#windows, the first byte is locked
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+
+    return True
+
+
+class EmbeddingCache():
+    def __init__(self,cache_dir,fingerprint,embed_length):
+        '''
+        on-disk store of the embeddings of a pb model, an image is embedded again only if its size or mtime changes.
+        The files are in the sub dir named by the sha1 of the pb file:
+        embeddings.bin: float32 rows of embed_length, appended image by image
+        embeddings_index.txt: path, size, mtime(ns), row of each image
+        embeddings.lock: held by the process adding embeddings, the other processes sharing the cache_dir read it only
+        :param cache_dir: dir of the caches of all models
+        :param fingerprint: pb_fingerprint() of the pb file
+        :param embed_length: the embedding length of the model
+        '''
+        # ----var
+        model_dir = os.path.join(cache_dir, fingerprint[:16])
+        data_path = os.path.join(model_dir, "embeddings.bin")
+        index_path = os.path.join(model_dir, "embeddings_index.txt")
+
+        if not os.path.exists(model_dir):
+            os.makedirs(model_dir)
+
+        # ----local var to global
+        self.fingerprint = fingerprint
+        self.model_dir = model_dir
+        self.data_path = data_path
+        self.index_path = index_path
+        self.lock_path = os.path.join(model_dir, "embeddings.lock")
+        self.embed_length = embed_length
+        self.f_lock = None
+        self.read_only = False
+        self.f_data = None
+        self.f_index = None
+        self.data = None
+        self.hits = 0
+        self.misses = 0
+
+        self.records, self.rows = self.read_index()
+
+    def read_index(self):
+        '''
+        records of the index(the last record of a path wins)
+        :return: dict of path to (size, mtime, row), rows recorded by the index
+        '''
+        records = dict()
+        rows = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.endswith('\n'):
+                        path, size, mtime, row = line[:-1].split('\t')
+                        records[path] = (int(size), int(mtime), int(row))
+                        rows = max(rows, int(row) + 1)
+        # ----the data is written before the index line, so a data file shorter than the index is corrupted
+        data_size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        if data_size < rows * self.embed_length * 4:
+            raise ValueError("{} has {} bytes, but {} rows are recorded by {}".format(self.data_path, data_size, rows,
+                                                                                    self.index_path))
+
+        return records, rows
+
+    def get(self,path,size,mtime):
+        '''
+        :return: row of the embedding, None if the image isn't cached or it's changed
+        '''
+        record = self.records.get(path)
+        if record is None or size is None or record[0] != size or record[1] != mtime:
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        return record[2]
+
+    def embeddings(self,rows):
+        '''
+        :param rows: list of rows from get()
+        :return: numpy array, [len(rows), embed_length]
+        '''
+        if self.data is None or len(self.data) <= max(rows):
+            self.data = np.memmap(self.data_path, dtype=np.float32, mode='r', shape=(self.rows, self.embed_length))
+
+        return self.data[rows]
+
+    def add(self,paths,stats,embeddings):
+        '''
+        :param stats: list of (size, mtime) from file_stat(), the images that don't exist are skipped
+        :param embeddings: numpy array, [len(paths), embed_length]
+        '''
+        if self.read_only:
+            return
+        if self.f_data is None:
+            # ----only the process holding the lock writes, the rows added by others since __init__ are read again
+            self.f_lock = open(self.lock_path, 'a')
+            if not lock_file(self.f_lock):
+                print("The embedding cache is written by another process, the new embeddings aren't cached:",
+                      self.model_dir)
+                self.f_lock.close()
+                self.f_lock = None
+                self.read_only = True
+                return
+            self.records, self.rows = self.read_index()
+            self.data = None
+            # ----rows written without index lines(a broken run) are dropped
+            if os.path.exists(self.data_path):
+                with open(self.data_path, 'r+b') as f:
+                    f.truncate(self.rows * self.embed_length * 4)
+            self.f_data = open(self.data_path, 'ab')
+            self.f_index = open(self.index_path, 'a', encoding='utf-8')
+        lines = list()
+        keep = list()
+        for idx, (path, (size, mtime)) in enumerate(zip(paths, stats)):
+            if size is not None:
+                row = self.rows + len(keep)
+                lines.append("{}\t{}\t{}\t{}\n".format(path, size, mtime, row))
+                self.records[path] = (size, mtime, row)
+                keep.append(idx)
+        if len(keep) == 0:
+            return
+        self.f_data.write(np.ascontiguousarray(embeddings[keep], dtype=np.float32).tobytes())
+        self.f_data.flush()
+        self.rows += len(keep)
+        self.f_index.write("".join(lines))
+        self.f_index.flush()
+
+    def close(self):
+        if self.f_data is not None:
+            self.f_data.close()
+            self.f_index.close()
+            self.f_data = None
+            self.f_index = None
+        if self.f_lock is not None:
+            self.f_lock.close()
+            self.f_lock = None
+
+
+class EmbeddingEngine():
+    def __init__(self,pb_path,node_dict=None,GPU_ratio=None,intra_threads=0,inter_threads=0,batch_size=64,
+                 decode_workers=4,prefetch=2,cache_dir=None):
+        '''
+        face embeddings of images with a face recognition pb model
+        :param node_dict: default: input, phase_train, embeddings and keep_prob(the ones not in the graph are skipped)
+        :param intra_threads: threads of one op(0: tf default)
+        :param inter_threads: threads of running independent ops(0: tf default)
+        :param batch_size: images of each session run
+        :param decode_workers: threads of decoding images
+        :param prefetch: batches decoded in the background while the model runs
+        :param cache_dir: dir of the on-disk embedding cache(EmbeddingCache), None: no cache
+        '''
+        # ----var
+        if node_dict is None:
+            node_dict = {'input': 'input:0',
+                         'phase_train': 'phase_train:0',
+                         'embeddings': 'embeddings:0',
+                         'keep_prob': 'keep_prob:0'
+                         }
+
+        # ----model init
+        fingerprint = pb_fingerprint(pb_path)
+        sess, tf_dict = model_restore_from_pb(pb_path, node_dict, GPU_ratio=GPU_ratio, intra_threads=intra_threads,
+                                              inter_threads=inter_threads)
+        tf_input = tf_dict['input']
+        tf_embeddings = tf_dict['embeddings']
+
+        # ----get the model shape
+        if tf_input.shape[1].value is None:
+            model_shape = (None, 160, 160, 3)
+        else:
+            model_shape = (None, tf_input.shape[1].value, tf_input.shape[2].value, 3)
+        print("The model shape of face recognition:", model_shape)
+
+        # ----set the feed_dict
+        feed_dict = dict()
+        if 'keep_prob' in tf_dict.keys():
+            feed_dict[tf_dict['keep_prob']] = 1.0
+        if 'phase_train' in tf_dict.keys():
+            feed_dict[tf_dict['phase_train']] = False
+
+        # ----embedding cache
+        if cache_dir is None:
+            cache = None
+        else:
+            cache = EmbeddingCache(cache_dir, fingerprint, tf_embeddings.shape[-1].value)
+
+        # ----local var to global
+        self.sess = sess
+        self.fingerprint = fingerprint
+        self.tf_dict = tf_dict
+        self.tf_input = tf_input
+        self.tf_embeddings = tf_embeddings
+        self.model_shape = model_shape
+        self.embed_length = tf_embeddings.shape[-1].value
+        self.feed_dict = feed_dict
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers
+        self.prefetch = prefetch
+        self.cache = cache
+
+    def img_preprocess(self,img):
+        '''
+        :param img: BGR image
+        :return: RGB image of the model shape, float32, [0,1]
+        '''
+        img = cv2.resize(img, (self.model_shape[2], self.model_shape[1]))
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        img = img.astype(np.float32)
+        img /= 255
+
+        return img
+
+    def read_img(self,path):
+        '''
+        :return: preprocessed image, zeros if the read fails
+        '''
+        img = cv2.imread(path)
+        if img is None:
+            print("Read failed:", path)
+            return np.zeros(self.model_shape[1:], dtype=np.float32)
+
+        return self.img_preprocess(img)
+
+    def run(self,batch_data):
+        '''
+        :param batch_data: numpy array, [N,H,W,3], preprocessed images
+        :return: embeddings, [N, embed_length]
+        '''
+        self.feed_dict[self.tf_input] = batch_data
+
+        return self.sess.run(self.tf_embeddings, feed_dict=self.feed_dict)
+
+    def embed_iter(self,data,batch_size=None):
+        '''
+        embeddings batch by batch, the image paths of the next batches are decoded in the background.
+        With the cache, only the images not in it are decoded and run, their embeddings are added to it
+        :param data: list of image paths, or numpy array [N,H,W,3] of preprocessed images
+        :param batch_size: None: self.batch_size
+        :return: generator of (num_start, num_end, embeddings of data[num_start:num_end])
+        '''
+        if batch_size is None:
+            batch_size = self.batch_size
+        len_data = len(data)
+        ites = math.ceil(len_data / batch_size)
+
+        if isinstance(data, np.ndarray):
+            for idx in range(ites):
+                num_start = idx * batch_size
+                num_end = min(num_start + batch_size, len_data)
+                yield num_start, num_end, self.run(data[num_start:num_end])
+            return
+
+        # ----decode thread: batches are put into a bounded queue, None is the end(also after an exception)
+        q = queue.Queue(maxsize=max(self.prefetch, 1))
+        stop = threading.Event()
+        errors = list()#the exception of the decode thread, re-raised by the consumer
+
+        def decode():
+            try:
+                decode_batches()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                q.put(None)
+
+        def decode_batches():
+            with ThreadPoolExecutor(max_workers=self.decode_workers) as executor:
+                for idx in range(ites):
+                    if stop.is_set():
+                        break
+                    num_start = idx * batch_size
+                    num_end = min(num_start + batch_size, len_data)
+                    paths = data[num_start:num_end]
+                    # ----rows of the cached images, None: to be embedded
+                    if self.cache is None:
+                        stats = None
+                        rows = [None] * len(paths)
+                    else:
+                        stats = list(executor.map(file_stat, paths))
+                        rows = [self.cache.get(path, size, mtime) for path, (size, mtime) in zip(paths, stats)]
+                    missing = [i for i, row in enumerate(rows) if row is None]
+                    if len(missing):
+                        batch_data = np.stack(list(executor.map(self.read_img, [paths[i] for i in missing])))
+                    else:
+                        batch_data = None
+                    q.put((num_start, num_end, batch_data, missing, rows, stats))
+
+        thread = threading.Thread(target=decode, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = q.get()
+                if item is None:
+                    if len(errors):
+                        raise errors[0]
+                    break
+                num_start, num_end, batch_data, missing, rows, stats = item
+                if batch_data is None:
+                    embed_batch = self.cache.embeddings(rows)
+                else:
+                    embed_missing = self.run(batch_data)
+                    if len(missing) == num_end - num_start:
+                        embed_batch = embed_missing
+                    else:
+                        hit = [i for i, row in enumerate(rows) if row is not None]
+                        embed_batch = np.zeros([num_end - num_start, self.embed_length], dtype=np.float32)
+                        embed_batch[hit] = self.cache.embeddings([rows[i] for i in hit])
+                        embed_batch[missing] = embed_missing
+                    if self.cache is not None:
+                        self.cache.add([data[num_start + i] for i in missing], [stats[i] for i in missing],
+                                       embed_missing)
+                yield num_start, num_end, embed_batch
+        finally:
+            #----the generator is closed early: let the decode thread finish
+            stop.set()
+            while thread.is_alive():
+                try:
+                    q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def embed(self,data,batch_size=None):
+        '''
+        :param data: list of image paths, or numpy array [N,H,W,3] of preprocessed images
+        :return: numpy array, [N, embed_length]
+        '''
+        embeddings = np.zeros([len(data), self.embed_length], dtype=np.float32)
+        for num_start, num_end, embed_batch in self.embed_iter(data, batch_size=batch_size):
+            embeddings[num_start:num_end] = embed_batch
+
+        return embeddings
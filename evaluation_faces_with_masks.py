@@ -1,104 +1,226 @@
-import os,math,cv2,shutil
+import os,json,hashlib
 import numpy as np
-import tensorflow
-
-#----tensorflow version check
-if tensorflow.__version__.startswith('1.'):
-    import tensorflow as tf
-    from tensorflow.python.platform import gfile
-else:
-    import tensorflow.compat.v1 as tf
-    tf.disable_v2_behavior()
-    import tensorflow.compat.v1.gfile as gfile
-print("Tensorflow version: ",tf.__version__)
-
-
-img_format = {'png', 'jpg', 'bmp'}
-
-
-def model_restore_from_pb(pb_path,node_dict,GPU_ratio=None):
-    tf_dict = dict()
-    with tf.Graph().as_default():
-        config = tf.ConfigProto(log_device_placement=True,
-                                allow_soft_placement=True,
-                                )
-        if GPU_ratio is None:
-            config.gpu_options.allow_growth = True
+from embedding_engine import EmbeddingEngine, img_format, pb_fingerprint, file_stat
+from ann_index import IVFPQIndex, load_ivfpq
+
+gallery_magic = b'FACEGAL\0'
+gallery_version = 2
+
+
+def nearest_neighbors(embed_tar,embed_ref,k=1,chunk_size=1024):
+    '''
+    the k nearest reference embeddings of each target by euclidean distance.
+    The squared distances of a chunk of targets come from one matrix product(|a|^2 + |b|^2 - 2ab),
+    so the memory is bounded by chunk_size * len(embed_ref)
+    :param embed_tar: numpy array, [N, embed_length]
+    :param embed_ref: numpy array, [M, embed_length]
+    :param k: neighbors of each target
+    :param chunk_size: targets of each matrix product
+    :return: indices [N, k] and distances [N, k], sorted by distance
+    '''
+    # ----var
+    embed_tar = np.asarray(embed_tar, dtype=np.float32)
+    embed_ref = np.asarray(embed_ref, dtype=np.float32)
+    len_tar = embed_tar.shape[0]
+    k = min(k, embed_ref.shape[0])
+    indices = np.zeros([len_tar, k], dtype=np.int64)
+    distances = np.zeros([len_tar, k], dtype=np.float32)
+    sq_norm_ref = np.sum(np.square(embed_ref), axis=1)
+
+    for num_start in range(0, len_tar, chunk_size):
+        num_end = min(num_start + chunk_size, len_tar)
+        chunk = embed_tar[num_start:num_end]
+        distance = np.dot(chunk, embed_ref.T)
+        distance *= -2
+        distance += sq_norm_ref[None, :]
+        distance += np.sum(np.square(chunk), axis=1)[:, None]
+        # ----top-k without sorting the whole row
+        if k == 1:
+            arg = np.argmin(distance, axis=1)[:, None]
+        elif k < distance.shape[1]:
+            arg = np.argpartition(distance, k - 1, axis=1)[:, :k]
         else:
-            config.gpu_options.per_process_gpu_memory_fraction = GPU_ratio
-        sess = tf.Session(config=config)
-        with gfile.FastGFile(pb_path, 'rb') as f:
-            graph_def = tf.GraphDef()
-            graph_def.ParseFromString(f.read())
-            sess.graph.as_default()
-
-            for node in graph_def.node:
-                if node.op == 'RefSwitch':
-                    node.op = 'Switch'
-                    for index in range(len(node.input)):
-                        if 'moving_' in node.input[index]:
-                            node.input[index] = node.input[index] + '/read'
-                elif node.op == 'AssignSub':
-                    node.op = 'Sub'
-                    if 'use_locking' in node.attr: del node.attr['use_locking']
-
-            tf.import_graph_def(graph_def, name='')
-
-        sess.run(tf.global_variables_initializer())
-        for key,value in node_dict.items():
-            try:
-                node = sess.graph.get_tensor_by_name(value)
-                tf_dict[key] = node
-            except:
-                print("node:{} does not exist in the graph".format(key))
-
-        return sess,tf_dict
-
-def get_embeddings(sess,paths,tf_dict,batch_size=128):
-    #----
-    len_path = len(paths)
-    tf_input = tf_dict['input']
-    tf_phase_train = tf_dict['phase_train']
-    tf_embeddings = tf_dict['embeddings']
-
-    feed_dict = {tf_phase_train: False}
-    if 'keep_prob' in tf_dict.keys():
-        tf_keep_prob = tf_dict['keep_prob']
-        feed_dict[tf_keep_prob] = 1.0
-
-    if tf_input.shape[1].value is None:
-        model_shape = [None, 160, 160, 3]
+            arg = np.tile(np.arange(distance.shape[1]), (num_end - num_start, 1))
+        dis = np.take_along_axis(distance, arg, axis=1)
+        order = np.argsort(dis, axis=1)
+        indices[num_start:num_end] = np.take_along_axis(arg, order, axis=1)
+        distances[num_start:num_end] = np.take_along_axis(dis, order, axis=1)
+
+    np.maximum(distances, 0, out=distances)#rounding errors of the matrix product
+
+    return indices, np.sqrt(distances)
+
+def path_label(path):
+    '''
+    :return: the identity of the image, the part of the filename before the first "_"
+    '''
+    return os.path.basename(path).split("_")[0]
+
+def gallery_listing(face_databse_dir):
+    '''
+    :return: sorted image paths of face_databse_dir and their [size, mtime(ns)]
+    '''
+    paths = sorted([file.path for file in os.scandir(face_databse_dir) if file.name[-3:] in img_format])
+    stats = [list(file_stat(path)) for path in paths]
+
+    return paths, stats
+
+def gallery_listing_path(gallery_path):
+    '''
+    :return: path of the sidecar of the gallery file with the paths and stats of the enrolled images
+    '''
+    return gallery_path + ".listing.json"
+
+def save_gallery(gallery_path,embeddings,paths,stats,fingerprint):
+    '''
+    gallery file: magic(8 bytes), header length(uint64), json header padded to 64 bytes, float32 embeddings [N, embed_length].
+    The header has version, fingerprint, count, embed_length, labels and listing(sha1 of the sidecar).
+    The paths and stats are in the sidecar(gallery_listing_path), they're read only to check if the gallery is stale.
+    Both are written to temp files first, the sidecar before the gallery: a broken run never leaves half a gallery,
+    and a sidecar newer than the gallery doesn't match its listing sha1
+    '''
+    listing = json.dumps({'paths': paths, 'stats': stats}, ensure_ascii=False).encode('utf-8')
+    header = {'version': gallery_version,
+              'fingerprint': fingerprint,
+              'count': len(paths),
+              'embed_length': int(embeddings.shape[-1]),
+              'labels': [path_label(path) for path in paths],
+              'listing': hashlib.sha1(listing).hexdigest(),
+              }
+    header = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    header += b' ' * (-(len(gallery_magic) + 8 + len(header)) % 64)#json ignores the trailing spaces
+
+    listing_path = gallery_listing_path(gallery_path)
+    with open(listing_path + ".tmp", 'wb') as f:
+        f.write(listing)
+    os.replace(listing_path + ".tmp", listing_path)
+
+    tmp_path = gallery_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(gallery_magic)
+        f.write(np.array(len(header), dtype=np.uint64).tobytes())
+        f.write(header)
+        f.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+    os.replace(tmp_path, gallery_path)
+
+def load_gallery(gallery_path):
+    '''
+    :return: dict of the header, 'embeddings' is a read-only memmap [count, embed_length],
+             None if the file isn't a gallery of this version
+    '''
+    with open(gallery_path, 'rb') as f:
+        if f.read(len(gallery_magic)) != gallery_magic:
+            return None
+        header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        gallery = json.loads(f.read(header_len).decode('utf-8'))
+    if gallery.get('version') != gallery_version:
+        return None
+
+    gallery['embeddings'] = np.memmap(gallery_path, dtype=np.float32, mode='r',
+                                      offset=len(gallery_magic) + 8 + header_len,
+                                      shape=(gallery['count'], gallery['embed_length']))
+
+    return gallery
+
+def load_gallery_listing(gallery_path,gallery):
+    '''
+    :param gallery: dict of load_gallery()
+    :return: paths and stats of the enrolled images, None, None if the sidecar is missing or doesn't match the gallery
+    '''
+    listing_path = gallery_listing_path(gallery_path)
+    if not os.path.exists(listing_path):
+        return None, None
+    with open(listing_path, 'rb') as f:
+        listing = f.read()
+    if hashlib.sha1(listing).hexdigest() != gallery['listing']:
+        return None, None
+    listing = json.loads(listing.decode('utf-8'))
+
+    return listing['paths'], listing['stats']
+
+def enroll_gallery(face_databse_dir,gallery_path,pb_path=None,engine=None,GPU_ratio=None,batch_size=128,
+                   cache_dir=None):
+    '''
+    embed the images of face_databse_dir into the gallery file, it's rebuilt only if the model or the images change
+    :param pb_path: used if engine is None
+    :param engine: EmbeddingEngine to reuse, None: built from pb_path only if the gallery needs a rebuild
+    :return: gallery dict of load_gallery()
+    '''
+    # ----var
+    paths, stats = gallery_listing(face_databse_dir)
+    if len(paths) == 0:
+        print("No images in ", face_databse_dir)
+        raise ValueError
+    if engine is None:
+        fingerprint = pb_fingerprint(pb_path)
     else:
-        model_shape = [None,tf_input.shape[1].value,tf_input.shape[2].value,3]
-
-    print("tf_input shape:",model_shape)
-
-    #----
-    ites = math.ceil(len_path / batch_size)
-    embeddings = np.zeros([len_path, tf_embeddings.shape[-1]], dtype=np.float32)
-    for idx in range(ites):
-        num_start = idx * batch_size
-        num_end = np.minimum(num_start + batch_size, len_path)
-        # ----read batch data
-        batch_dim = [num_end - num_start] #normally num_end - num_start = batch_size, but not in the last batch
-        batch_dim.extend(model_shape[1:])
-        batch_data = np.zeros(batch_dim, dtype=np.float32)
-        for idx_path, path in enumerate(paths[num_start:num_end]):
-            img = cv2.imread(path)
-            if img is None:
-                print("Read failed:", path)
-            else:
-                img = cv2.resize(img, (model_shape[2], model_shape[1]))
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                batch_data[idx_path] = img
-        batch_data /= 255  # norm
-        feed_dict[tf_input] = batch_data
-        embeddings[num_start:num_end] = sess.run(tf_embeddings, feed_dict=feed_dict)
-
-
-    return embeddings
-
-def evaluation(test_dir,face_databse_dir,pb_path,GPU_ratio=None):
+        fingerprint = engine.fingerprint
+
+    # ----check the existing gallery
+    if os.path.exists(gallery_path):
+        gallery = load_gallery(gallery_path)
+        if gallery is not None and gallery['fingerprint'] == fingerprint and gallery['count'] == len(paths) and \
+                load_gallery_listing(gallery_path, gallery) == (paths, stats):
+            print("gallery is up to date:", gallery_path)
+            return gallery
+        gallery = None#release the memmap before the file is replaced
+
+    # ----enrollment
+    if engine is None:
+        engine = EmbeddingEngine(pb_path, GPU_ratio=GPU_ratio, batch_size=batch_size, cache_dir=cache_dir)
+    embeddings = engine.embed(paths)
+    save_gallery(gallery_path, embeddings, paths, stats, fingerprint)
+    print("gallery enrolled:{}, images:{}".format(gallery_path, len(paths)))
+
+    return load_gallery(gallery_path)
+
+def gallery_ann_index(embed_ref,ann_para,gallery_path=None):
+    '''
+    IVFPQIndex of the reference embeddings, saved next to the gallery file and rebuilt only if the gallery file or
+    the build parameters change
+    :param ann_para: dict of IVFPQIndex parameters, nprobe and rerank can change without a rebuild
+    :return: IVFPQIndex with the vectors for re-ranking
+    '''
+    # ----var
+    build_para = {key: value for key, value in ann_para.items() if key not in ('nprobe', 'rerank')}
+    index = None
+    source = None
+
+    # ----load the saved index
+    if gallery_path is not None:
+        index_path = gallery_path + ".ivfpq.npz"
+        source = json.dumps({'gallery': file_stat(gallery_path), 'para': build_para}, sort_keys=True)
+        if os.path.exists(index_path):
+            index, saved_source = load_ivfpq(index_path)
+            if saved_source != source or index.count != len(embed_ref):
+                index = None
+
+    # ----build the index
+    if index is None:
+        index = IVFPQIndex(**ann_para)
+        index.build(embed_ref)
+        if gallery_path is not None:
+            index.save(index_path, source=source)
+            print("ANN index saved:", index_path)
+
+    index.vectors = embed_ref
+    if 'nprobe' in ann_para.keys():
+        index.nprobe = ann_para['nprobe']
+    if 'rerank' in ann_para.keys():
+        index.rerank = ann_para['rerank']
+
+    return index
+
+def evaluation(test_dir,face_databse_dir,pb_path,GPU_ratio=None,cache_dir=None,gallery_path=None,ann_para=None,
+               enroll=False):
+    '''
+    :param gallery_path: gallery file of face_databse_dir(enroll_gallery), None: embed face_databse_dir every time
+    :param enroll: True: check the images of face_databse_dir against the gallery(enroll_gallery) before matching.
+                   False: the gallery is loaded as it is, only the model fingerprint is checked(O(1), no listing
+                   of face_databse_dir), it's enrolled only if it's missing or of another model
+    :param ann_para: dict of IVFPQIndex parameters for the approximate matching of large galleries,
+                     None: exhaustive matching
+    '''
     #----var
     paths_test = list()
     node_dict = {'input': 'input:0',
@@ -107,8 +229,6 @@ def evaluation(test_dir,face_databse_dir,pb_path,GPU_ratio=None):
                  'keep_prob':'keep_prob:0'
                  }
     batch_size = 128
-    arg_dis = list()
-    dis_list = list()
     count_o = 0
     count_unknown = 0
     threshold = 0.8
@@ -124,50 +244,50 @@ def evaluation(test_dir,face_databse_dir,pb_path,GPU_ratio=None):
         print("No images in ",test_dir)
         raise ValueError
 
-    #----get images of face_databse_dir
-    paths_ref = [file.path for file in os.scandir(face_databse_dir) if file.name[-3:] in img_format]
-    len_path_ref = len(paths_ref)
-    if len_path_ref == 0:
-        print("No images in ", face_databse_dir)
-        raise ValueError
-
     #----model init
-    sess, tf_dict = model_restore_from_pb(pb_path, node_dict, GPU_ratio=GPU_ratio)
-    tf_embeddings = tf_dict['embeddings']
-
-    #----tf setting for calculating distance
-    with tf.Graph().as_default():
-        tf_tar = tf.placeholder(dtype=tf.float32, shape=tf_embeddings.shape[-1])
-        tf_ref = tf.placeholder(dtype=tf.float32, shape=tf_embeddings.shape)
-        tf_dis = tf.sqrt(tf.reduce_sum(tf.square(tf.subtract(tf_ref, tf_tar)), axis=1))
-        # ----GPU setting
-        config = tf.ConfigProto(log_device_placement=True,
-                                allow_soft_placement=True,
-                                )
-        config.gpu_options.allow_growth = True
-        sess_cal = tf.Session(config=config)
-        sess_cal.run(tf.global_variables_initializer())
-
-    #----get embeddings
-    embed_ref = get_embeddings(sess, paths_ref, tf_dict, batch_size=batch_size)
-    embed_tar = get_embeddings(sess, paths_test, tf_dict, batch_size=batch_size)
+    engine = EmbeddingEngine(pb_path, node_dict, GPU_ratio=GPU_ratio, batch_size=batch_size, cache_dir=cache_dir)
+
+    #----get embeddings of face_databse_dir, from the gallery file if given
+    if gallery_path is None:
+        paths_ref = [file.path for file in os.scandir(face_databse_dir) if file.name[-3:] in img_format]
+        if len(paths_ref) == 0:
+            print("No images in ", face_databse_dir)
+            raise ValueError
+        labels_ref = [path_label(path) for path in paths_ref]
+        embed_ref = engine.embed(paths_ref)
+    else:
+        gallery = None
+        if not enroll and os.path.exists(gallery_path):
+            gallery = load_gallery(gallery_path)
+            if gallery is not None and gallery['fingerprint'] != engine.fingerprint:
+                print("the gallery is of another model:", gallery_path)
+                gallery = None
+        if gallery is None:
+            gallery = enroll_gallery(face_databse_dir, gallery_path, engine=engine)
+        labels_ref = gallery['labels']
+        embed_ref = gallery['embeddings']
+
+    #----get embeddings of test images
+    embed_tar = engine.embed(paths_test)
     print("embed_ref shape: ", embed_ref.shape)
     print("embed_tar shape: ", embed_tar.shape)
+    if engine.cache is not None:
+        print("embedding cache hits:{}, misses:{}".format(engine.cache.hits, engine.cache.misses))
 
     #----calculate distance and get the minimum index
-    feed_dict_2 = {tf_ref: embed_ref}
-    for idx, embedding in enumerate(embed_tar):
-        feed_dict_2[tf_tar] = embedding
-        distance = sess_cal.run(tf_dis, feed_dict=feed_dict_2)
-        arg_temp = np.argsort(distance)[0]
-        arg_dis.append(arg_temp)
-        dis_list.append(distance[arg_temp])
+    if ann_para is None:
+        arg_dis, dis_list = nearest_neighbors(embed_tar, embed_ref, k=1)
+    else:
+        index = gallery_ann_index(embed_ref, ann_para, gallery_path=gallery_path)
+        arg_dis, dis_list = index.search(embed_tar, k=1)
+    arg_dis = arg_dis[:, 0]
+    dis_list = dis_list[:, 0]
 
     for idx, path in enumerate(paths_test):
-        answer = path.split("\\")[-1].split("_")[0]
+        answer = path_label(path)
 
         arg = arg_dis[idx]
-        prediction = paths_ref[arg].split("\\")[-1].split("_")[0]
+        prediction = labels_ref[arg]
 
         dis = dis_list[idx]
 
@@ -194,5 +314,15 @@ if __name__ == "__main__":
     # pb_path = r"G:\我的雲端硬碟\Python\Code\model_saver\face_reg_models\FLW_0.98\pb_model.pb"
     pb_path = r"C:\Users\aarya\Downloads\CASIA-WebFace\pb files\pb_model.pb"
     # pb_path = r"G:\我的雲端硬碟\xxx\pb_model_select_num=15.pb"
+    cache_dir = r"C:\Users\aarya\Downloads\embedding_cache"
+    gallery_path = r"C:\Users\aarya\Downloads\dataset_1000images\test_database_2\no_mask_gallery.bin"
+
+    #----approximate matching for million-scale galleries
+    # ann_para = {'n_list': 1024, 'm': 16, 'nprobe': 16, 'rerank': 100}
+    ann_para = None
+
+    #----enrollment only, run it after the images of face_databse_dir change(or evaluation(enroll=True))
+    # enroll_gallery(face_databse_dir, gallery_path, pb_path=pb_path, GPU_ratio=None, cache_dir=cache_dir)
 
-    evaluation(root_dir, face_databse_dir, pb_path, GPU_ratio=None)
\ No newline at end of file
+    evaluation(root_dir, face_databse_dir, pb_path, GPU_ratio=None, cache_dir=cache_dir, gallery_path=gallery_path,
+               ann_para=ann_para)
\ No newline at end of file
@@ -1,55 +1,334 @@
 import numpy as np
-import tensorflow
 
-import os, time, cv2
+import os, re, time, cv2, json, queue, threading, array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import matplotlib.pyplot as plt
+from embedding_engine import model_restore_from_pb
 
 
-if tensorflow.__version__.startswith('1.'):
-    import tensorflow as tf
-    from tensorflow.python.platform import gfile
-else:
-    import tensorflow.compat.v1 as tf
-    tf.disable_v2_behavior()
-    import tensorflow.compat.v1.gfile as gfile
 
-print("Tensorflow version: ",tf.__version__)
+def max_class_score(y_cls):
+    '''
+    the same as np.max(y_cls, axis=-1), numpy is slow to reduce such a short last axis(2 classes)
+    :param y_cls: numpy array, [..., num_classes]
+    :return: numpy array, [...]
+    '''
+    scores = y_cls[..., 0]
+    for i in range(1, y_cls.shape[-1]):
+        scores = np.maximum(scores, y_cls[..., i])
 
+    return scores
 
+def iou_matrix(bboxes_a, bboxes_b, area_a=None, area_b=None):
+    '''
+    IOU of every pair of bboxes, the same formula as single_class_non_max_suppression
+    :param bboxes_a: numpy array, [M, 4], [xmin, ymin, xmax, ymax]
+    :param bboxes_b: numpy array, [N, 4], [xmin, ymin, xmax, ymax]
+    :param area_a: numpy array, [M], precomputed areas of bboxes_a
+    :param area_b: numpy array, [N], precomputed areas of bboxes_b
+    :return: numpy array, [M, N]
+    '''
+    if area_a is None:
+        area_a = (bboxes_a[:, 2] - bboxes_a[:, 0] + 1e-3) * (bboxes_a[:, 3] - bboxes_a[:, 1] + 1e-3)
+    if area_b is None:
+        area_b = (bboxes_b[:, 2] - bboxes_b[:, 0] + 1e-3) * (bboxes_b[:, 3] - bboxes_b[:, 1] + 1e-3)
+    overlap_xmin = np.maximum(bboxes_a[:, None, 0], bboxes_b[None, :, 0])
+    overlap_ymin = np.maximum(bboxes_a[:, None, 1], bboxes_b[None, :, 1])
+    overlap_xmax = np.minimum(bboxes_a[:, None, 2], bboxes_b[None, :, 2])
+    overlap_ymax = np.minimum(bboxes_a[:, None, 3], bboxes_b[None, :, 3])
+    overlap_w = np.maximum(0, overlap_xmax - overlap_xmin)
+    overlap_h = np.maximum(0, overlap_ymax - overlap_ymin)
+    overlap_area = overlap_w * overlap_h
 
-def model_restore_from_pb(pb_path, node_dict,GPU_ratio=None):
-    tf_dict = dict()
-    with tf.Graph().as_default():
-        config = tf.ConfigProto(log_device_placement=True,  #print out GPU or CPU is adopted
-                                allow_soft_placement=True,  #allow tf to use alternative devices
-                                )
-        if GPU_ratio is None:
-            config.gpu_options.allow_growth = True  # The program can access as much resource as possible
+    return overlap_area / (area_a[:, None] + area_b[None, :] - overlap_area)
+
+class StageTimer():
+    def __init__(self):
+        '''
+        latency record of each stage(imread, preprocess, sess_run, decode_bbox, nms, imwrite), thread safe.
+        The batch stages(sess_run, decode_bbox) are recorded once per batch.
+        '''
+        self.records = dict()#stage name: array of seconds
+        self.img_quantity = 0
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self,name):
+        d_t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - d_t)
+
+    def record(self,name,seconds):
+        with self.lock:
+            if name not in self.records:
+                self.records[name] = array.array('d')
+            self.records[name].append(seconds)
+
+    def add_images(self,quantity):
+        with self.lock:
+            self.img_quantity += quantity
+
+    def summary(self):
+        '''
+        :return: dict of the count, total, mean, p50, p95, p99, max(seconds) and the histogram of each stage.
+                 The histogram bins are log spaced, 4 bins per decade from 1us to 100s.
+        '''
+        elapsed = time.time() - self.start_time
+        bin_edges = np.logspace(-6, 2, 33)
+        content = {'elapsed': elapsed,
+                   'img_quantity': self.img_quantity,
+                   'img_per_second': self.img_quantity / elapsed if elapsed > 0 else 0.0,
+                   'histogram_bin_edges': bin_edges.tolist(),
+                   'stages': dict()}
+        with self.lock:
+            for name, values in self.records.items():
+                values = np.frombuffer(values, dtype=np.float64)
+                if len(values) == 0:
+                    continue
+                p50, p95, p99 = np.percentile(values, [50, 95, 99])
+                hist, _ = np.histogram(np.clip(values, bin_edges[0], bin_edges[-1]), bins=bin_edges)
+                content['stages'][name] = {'count': int(len(values)),
+                                           'total': float(np.sum(values)),
+                                           'mean': float(np.mean(values)),
+                                           'p50': float(p50),
+                                           'p95': float(p95),
+                                           'p99': float(p99),
+                                           'max': float(np.max(values)),
+                                           'histogram': hist.tolist()}
+
+        return content
+
+    def report(self,json_path=None):
+        content = self.summary()
+        print("--------Stage timing--------")
+        for name, stat in content['stages'].items():
+            print("{}: count:{}, total:{:.3f}s, p50:{:.6f}s, p95:{:.6f}s, p99:{:.6f}s".format(
+                name, stat['count'], stat['total'], stat['p50'], stat['p95'], stat['p99']))
+        print("images per second:", content['img_per_second'])
+        if json_path is not None:
+            with open(json_path, 'w') as f:
+                json.dump(content, f, indent=4)
+            print("save the timing to ", json_path)
+
+        return content
+
+@contextmanager
+def timing(timer,name):
+    '''
+    record the time of the with block to the timer, nothing is done if the timer is None
+    '''
+    if timer is None:
+        yield
+    else:
+        with timer.stage(name):
+            yield
+
+#----anchors of each feature map layout, generated once per process
+anchors_cache = dict()
+
+class BoxPostProcess():
+    def __init__(self,margin=44,conf_thresh=0.8,iou_thresh=0.7,pre_top_k=-1):
+        '''
+        NMS and box scaling of the decoded detections, no session is needed(see img_recrop)
+        :param pre_top_k: only the pre_top_k most confident bboxes passing conf_thresh take part in NMS,
+                          -1 means all of them(see nms_benchmark for the speed of e.g. 400 with low conf_thresh)
+        '''
+        # ----local var to global
+        self.conf_thresh = conf_thresh
+        self.iou_thresh = iou_thresh
+        self.pre_top_k = pre_top_k
+        self.margin = margin
+        self.timer = None#StageTimer, set it to record the latency of sess_run, decode_bbox and nms
+
+    def single_class_non_max_suppression(self,bboxes, confidences, conf_thresh=0.2, iou_thresh=0.5, keep_top_k=-1):
+        '''
+        do nms on single class.
+        Hint: for the specific class, given the bbox and its confidence,
+        1) sort the bbox according to the confidence from top to down, we call this a set
+        2) select the bbox with the highest confidence, remove it from set, and do IOU calculate with the rest bbox
+        3) remove the bbox whose IOU is higher than the iou_thresh from the set,
+        4) loop step 2 and 3, util the set is empty.
+        :param bboxes: numpy array of 2D, [num_bboxes, 4]
+        :param confidences: numpy array of 1D. [num_bboxes]
+        :param conf_thresh:
+        :param iou_thresh:
+        :param keep_top_k: -1 means keeping all bboxes, else at most keep_top_k bboxes(fewer ones are not padded,
+                           the callers take a list of any length)
+        :return:
+        '''
+        if len(bboxes) == 0: return []
+
+        conf_keep_idx = np.where(confidences > conf_thresh)[0]
+
+        bboxes = bboxes[conf_keep_idx]
+        confidences = confidences[conf_keep_idx]
+
+        pick = []
+        xmin = bboxes[:, 0]
+        ymin = bboxes[:, 1]
+        xmax = bboxes[:, 2]
+        ymax = bboxes[:, 3]
+
+        area = (xmax - xmin + 1e-3) * (ymax - ymin + 1e-3)
+        idxs = np.argsort(confidences)
+
+        while len(idxs) > 0:
+            last = len(idxs) - 1
+            i = idxs[last]
+            pick.append(i)
+
+            # keep top k
+            if keep_top_k != -1:
+                if len(pick) >= keep_top_k:
+                    break
+
+            overlap_xmin = np.maximum(xmin[i], xmin[idxs[:last]])
+            overlap_ymin = np.maximum(ymin[i], ymin[idxs[:last]])
+            overlap_xmax = np.minimum(xmax[i], xmax[idxs[:last]])
+            overlap_ymax = np.minimum(ymax[i], ymax[idxs[:last]])
+            overlap_w = np.maximum(0, overlap_xmax - overlap_xmin)
+            overlap_h = np.maximum(0, overlap_ymax - overlap_ymin)
+            overlap_area = overlap_w * overlap_h
+            overlap_ratio = overlap_area / (area[idxs[:last]] + area[i] - overlap_area)
+
+            need_to_be_deleted_idx = np.concatenate(([last], np.where(overlap_ratio > iou_thresh)[0]))
+            idxs = np.delete(idxs, need_to_be_deleted_idx)
+
+        return conf_keep_idx[pick]
+
+    def fast_non_max_suppression(self,bboxes, confidences, conf_thresh=0.2, iou_thresh=0.5, keep_top_k=-1,
+                                 pre_top_k=-1, min_block=4, max_block=32):
+        '''
+        vectorized NMS on single class, it picks the same bboxes as single_class_non_max_suppression.
+        1) keep the bboxes whose confidence > conf_thresh(only the pre_top_k highest ones if pre_top_k != -1)
+        2) sort them by confidence from top to down, we call this a set
+        3) take a block of the top bboxes from the set and do IOU calculate with the whole set as one matrix
+        4) do greedy NMS inside the block with the block part of the matrix
+        5) remove the block and the bboxes whose IOU with the kept ones is higher than the iou_thresh from the set
+        6) loop step 3 to 5, util the set is empty. The block size grows when most of a block is kept and
+           shrinks when most of a block is suppressed.
+        :param bboxes: numpy array, [num_bboxes, 4] or [batch, num_bboxes, 4]
+        :param confidences: numpy array, [num_bboxes] or [batch, num_bboxes]
+        :param conf_thresh:
+        :param iou_thresh:
+        :param keep_top_k: -1 means keeping all bboxes after NMS, else at most keep_top_k bboxes(not padded)
+        :param pre_top_k: -1 means all bboxes passing conf_thresh take part in NMS
+        :param min_block: the min block size
+        :param max_block: the max block size, the IOU matrix is at most [max_block, num_bboxes]
+        :return: numpy array of the kept indices, a list of them if the inputs are batched
+        '''
+        if bboxes.ndim == 3:
+            return [self.fast_non_max_suppression(b, c, conf_thresh=conf_thresh, iou_thresh=iou_thresh,
+                                                  keep_top_k=keep_top_k, pre_top_k=pre_top_k,
+                                                  min_block=min_block, max_block=max_block)
+                    for b, c in zip(bboxes, confidences)]
+
+        conf_keep_idx = np.where(confidences > conf_thresh)[0]
+        confidences = confidences[conf_keep_idx]
+
+        # ----sort by confidence(top to down), argpartition first to bound the sorting
+        if pre_top_k != -1 and pre_top_k < len(conf_keep_idx):
+            top = np.argpartition(confidences, len(confidences) - pre_top_k)[len(confidences) - pre_top_k:]
+            order = top[np.argsort(confidences[top])[::-1]]
         else:
-            config.gpu_options.per_process_gpu_memory_fraction = GPU_ratio  # limit the GPU resource
-        sess = tf.Session(config=config)
-        with gfile.FastGFile(pb_path, 'rb') as f:
-            graph_def = tf.GraphDef()
-            graph_def.ParseFromString(f.read())
-            sess.graph.as_default()
-            tf.import_graph_def(graph_def, name='')  # import the calculation graph
-        sess.run(tf.global_variables_initializer())
-        for key, value in node_dict.items():
-            try:
-                node = sess.graph.get_tensor_by_name(value)
-                tf_dict[key] = node
-            except:
-                print("node:{} does not exist in the graph")
-        return sess, tf_dict
-
-class FaceMaskDetection():
-    def __init__(self,pb_path,margin=44,GPU_ratio=0.1):
+            order = np.argsort(confidences)[::-1]
+        bboxes = bboxes[conf_keep_idx[order]]
+        area = (bboxes[:, 2] - bboxes[:, 0] + 1e-3) * (bboxes[:, 3] - bboxes[:, 1] + 1e-3)
+
+        pick = list()
+        alive = np.ones(len(order), dtype=bool)
+        block_size = min_block
+        while True:
+            rest = np.where(alive)[0]
+            if len(rest) == 0:
+                break
+            block = rest[:block_size]
+            suppress = iou_matrix(bboxes[block], bboxes[rest], area[block], area[rest]) > iou_thresh
+
+            # ----greedy NMS inside the block
+            block_alive = np.ones(len(block), dtype=bool)
+            block_pick = list()
+            for i in range(len(block)):
+                if block_alive[i]:
+                    block_pick.append(i)
+                    block_alive[i + 1:] &= ~suppress[i, i + 1:len(block)]
+            pick.extend(block[block_pick])
+
+            # keep top k
+            if keep_top_k != -1 and len(pick) >= keep_top_k:
+                pick = pick[:keep_top_k]
+                break
+
+            # ----remove the block and the bboxes overlapping the kept ones
+            alive[rest[np.any(suppress[block_pick], axis=0)]] = False
+            alive[block] = False
+
+            # ----block size adaption
+            if len(block_pick) * 2 > len(block):
+                block_size = min(block_size * 2, max_block)
+            elif len(block_pick) * 4 < len(block):
+                block_size = max(block_size // 2, min_block)
+
+        return conf_keep_idx[order[np.array(pick, dtype=np.int64)]]
+
+    def post_process(self,y_bboxes,y_cls,ori_height,ori_width):
+        '''
+        NMS and box scaling of one image
+        :param y_bboxes: numpy array, [num_anchors, 4], decoded bboxes
+        :param y_cls: numpy array, [num_anchors, num_classes]
+        :param ori_height: height of the original image
+        :param ori_width: width of the original image
+        :return: re_boxes, re_confidence, re_classes, re_mask_id
+        '''
+        # ----var
+        re_boxes = list()
+        re_confidence = list()
+        re_classes = list()
+        re_mask_id = list()
+
+        # To speed up, do single class NMS, not multiple classes NMS.
+        bbox_max_scores = max_class_score(y_cls)
+
+        # keep_idx is the alive bounding box after nms.
+        with timing(self.timer, 'nms'):
+            keep_idxs = self.fast_non_max_suppression(y_bboxes, bbox_max_scores, conf_thresh=self.conf_thresh,
+                                                      iou_thresh=self.iou_thresh, pre_top_k=self.pre_top_k)
+        # ====draw bounding box
+        for idx in keep_idxs:
+            conf = float(bbox_max_scores[idx])
+            #print("conf = ",conf)
+            class_id = np.argmax(y_cls[idx])
+            bbox = y_bboxes[idx]
+            #print(bbox)
+
+            xmin = np.maximum(0, int(bbox[0] * ori_width - self.margin / 2))
+            ymin = np.maximum(0, int(bbox[1] * ori_height - self.margin / 2))
+            xmax = np.minimum(int(bbox[2] * ori_width + self.margin / 2), ori_width)
+            ymax = np.minimum(int(bbox[3] * ori_height + self.margin / 2), ori_height)
+
+            re_boxes.append([xmin, ymin, xmax - xmin, ymax - ymin])
+            re_confidence.append(conf)
+            re_classes.append('face')
+            re_mask_id.append(class_id)
+        return re_boxes, re_confidence, re_classes, re_mask_id
+
+class FaceMaskDetection(BoxPostProcess):
+    def __init__(self,pb_path,margin=44,GPU_ratio=0.1,conf_thresh=0.8,iou_thresh=0.7,input_size=None,pre_top_k=-1):
+        '''
+        :param input_size: None to use the 260x260 input of the pb, or int/(width, height) to reshape the input,
+                           for example 160 or 192 for images with large faces. The feature map sizes are read from
+                           the reshaped graph and the anchors are generated for them.
+        :param pre_top_k: the bound of the bboxes taking part in NMS, -1 means no bound(see BoxPostProcess)
+        '''
         # ----var
         node_dict = {'input': 'data_1:0',
                      'detection_bboxes': 'loc_branch_concat_1/concat:0',
                      'detection_scores': 'cls_branch_concat_1/concat:0'}
-        conf_thresh = 0.8
-        iou_thresh = 0.7
+        feature_map_nodes = ['cls_{}_conv_1/BiasAdd:0'.format(i) for i in range(5)]
 
         # ====anchors config
         feature_map_sizes = [[33, 33], [17, 17], [9, 9], [5, 5], [3, 3]]
@@ -58,14 +337,15 @@ class FaceMaskDetection():
         id2class = {0: 'Mask', 1: 'NoMask'}
 
         # ----model init
-        # ====generate anchors
-        anchors = self.generate_anchors(feature_map_sizes, anchor_sizes, anchor_ratios)
-        # for inference , the batch size is 1, the model output shape is [1, N, 4],
-        # so we expand dim for anchors to [1, anchor_num, 4]
-        anchors_exp = np.expand_dims(anchors, axis=0)
-
         # ====model restore from pb file
-        sess, tf_dict = model_restore_from_pb(pb_path, node_dict,GPU_ratio = GPU_ratio)
+        input_shape = None
+        if input_size is not None:
+            if isinstance(input_size, int):
+                input_size = (input_size, input_size)
+            input_shape = [None, input_size[1], input_size[0], 3]
+            for idx, name in enumerate(feature_map_nodes):
+                node_dict['feature_map_{}'.format(idx)] = name
+        sess, tf_dict = model_restore_from_pb(pb_path, node_dict,GPU_ratio = GPU_ratio, input_shape=input_shape)
         tf_input = tf_dict['input']
         model_shape = tf_input.shape  # [N,H,W,C]
         print("model_shape = ", model_shape)
@@ -73,7 +353,32 @@ class FaceMaskDetection():
         detection_bboxes = tf_dict['detection_bboxes']
         detection_scores = tf_dict['detection_scores']
 
+        # ====feature map sizes([W,H]) of the reshaped input
+        if input_size is not None:
+            feature_map_sizes = list()
+            for idx in range(len(feature_map_nodes)):
+                shape = tf_dict['feature_map_{}'.format(idx)].shape  # [N,H,W,C]
+                feature_map_sizes.append([shape[2].value, shape[1].value])
+            print("feature_map_sizes = ", feature_map_sizes)
+
+        # ====generate anchors
+        key = str(feature_map_sizes)
+        if key not in anchors_cache:
+            anchors = self.generate_anchors(feature_map_sizes, anchor_sizes, anchor_ratios)
+            # the model output shape is [batch, N, 4], so we expand dim for anchors to [1, anchor_num, 4]
+            # and let numpy broadcast it over the whole batch
+            anchors_cache[key] = np.expand_dims(anchors, axis=0)
+        anchors_exp = anchors_cache[key]
+
+        # ====anchor constants of bbox decoding, [num_anchors, 4], (center x, center y, width, height)
+        anchor_consts = np.concatenate([(anchors_exp[0, :, 0:1] + anchors_exp[0, :, 2:3]) / 2,
+                                        (anchors_exp[0, :, 1:2] + anchors_exp[0, :, 3:]) / 2,
+                                        anchors_exp[0, :, 2:3] - anchors_exp[0, :, 0:1],
+                                        anchors_exp[0, :, 3:] - anchors_exp[0, :, 1:2]], axis=-1)
+
         # ----local var to global
+        BoxPostProcess.__init__(self, margin=margin, conf_thresh=conf_thresh, iou_thresh=iou_thresh,
+                                pre_top_k=pre_top_k)
         self.model_shape = model_shape
         self.img_size = img_size
         self.sess = sess
@@ -81,10 +386,10 @@ class FaceMaskDetection():
         self.detection_bboxes = detection_bboxes
         self.detection_scores = detection_scores
         self.anchors_exp = anchors_exp
-        self.conf_thresh = conf_thresh
-        self.iou_thresh = iou_thresh
+        self.anchor_consts = anchor_consts
         self.id2class = id2class
-        self.margin = margin
+        self.feature_map_sizes = feature_map_sizes
+        self.min_anchor_size = float(np.min(anchor_sizes))
 
     def generate_anchors(self,feature_map_sizes, anchor_sizes, anchor_ratios, offset=0.5):
         '''
@@ -132,8 +437,8 @@ class FaceMaskDetection():
         '''
         Decode the actual bbox according to the anchors.
         the anchor value order is:[xmin,ymin, xmax, ymax]
-        :param anchors: numpy array with shape [batch, num_anchors, 4]
-        :param raw_outputs: numpy array with the same shape with anchors
+        :param anchors: numpy array with shape [1, num_anchors, 4] or [batch, num_anchors, 4]
+        :param raw_outputs: numpy array with shape [batch, num_anchors, 4], anchors are broadcast over the batch
         :param variances: list of float, default=[0.1, 0.1, 0.2, 0.2]
         :return:
         '''
@@ -153,102 +458,614 @@ class FaceMaskDetection():
         predict_bbox = np.concatenate([predict_xmin, predict_ymin, predict_xmax, predict_ymax], axis=-1)
         return predict_bbox
 
-    def single_class_non_max_suppression(self,bboxes, confidences, conf_thresh=0.2, iou_thresh=0.5, keep_top_k=-1):
+    def decode_bbox_selected(self,raw_outputs,anchor_idx,variances=[0.1, 0.1, 0.2, 0.2]):
         '''
-        do nms on single class.
-        Hint: for the specific class, given the bbox and its confidence,
-        1) sort the bbox according to the confidence from top to down, we call this a set
-        2) select the bbox with the highest confidence, remove it from set, and do IOU calculate with the rest bbox
-        3) remove the bbox whose IOU is higher than the iou_thresh from the set,
-        4) loop step 2 and 3, util the set is empty.
-        :param bboxes: numpy array of 2D, [num_bboxes, 4]
-        :param confidences: numpy array of 1D. [num_bboxes]
-        :param conf_thresh:
-        :param iou_thresh:
-        :param keep_top_k:
-        :return:
+        decode the bboxes of the selected anchors only, with the anchor constants computed in __init__.
+        The results are the same as the ones of decode_bbox.
+        :param raw_outputs: numpy array, [num_selected, 4], model outputs of the selected anchors
+        :param anchor_idx: numpy array, [num_selected], indices of the selected anchors
+        :param variances: list of float, default=[0.1, 0.1, 0.2, 0.2]
+        :return: numpy array, [num_selected, 4]
         '''
-        if len(bboxes) == 0: return []
+        anchor_consts = self.anchor_consts[anchor_idx]
+        anchor_centers_x = anchor_consts[:, 0:1]
+        anchor_centers_y = anchor_consts[:, 1:2]
+        anchors_w = anchor_consts[:, 2:3]
+        anchors_h = anchor_consts[:, 3:]
+        raw_outputs_rescale = raw_outputs * np.array(variances)
+        predict_center_x = raw_outputs_rescale[:, 0:1] * anchors_w + anchor_centers_x
+        predict_center_y = raw_outputs_rescale[:, 1:2] * anchors_h + anchor_centers_y
+        predict_w = np.exp(raw_outputs_rescale[:, 2:3]) * anchors_w
+        predict_h = np.exp(raw_outputs_rescale[:, 3:]) * anchors_h
+        predict_xmin = predict_center_x - predict_w / 2
+        predict_ymin = predict_center_y - predict_h / 2
+        predict_xmax = predict_center_x + predict_w / 2
+        predict_ymax = predict_center_y + predict_h / 2
+        predict_bbox = np.concatenate([predict_xmin, predict_ymin, predict_xmax, predict_ymax], axis=-1)
+        return predict_bbox
 
-        conf_keep_idx = np.where(confidences > conf_thresh)[0]
+    def select_decode(self,raw_outputs,y_cls_output,score_thresh):
+        '''
+        filter the anchors of a batch by the max class score first, then decode the selected ones in one call
+        :param raw_outputs: numpy array, [batch, num_anchors, 4], model outputs
+        :param y_cls_output: numpy array, [batch, num_anchors, num_classes]
+        :param score_thresh: the anchors whose max class score > score_thresh are selected
+        :return: list of (decoded bboxes [num_selected, 4], class scores [num_selected, num_classes]) of each image
+        '''
+        batch_idx, anchor_idx = np.where(max_class_score(y_cls_output) > score_thresh)
+        y_bboxes = self.decode_bbox_selected(raw_outputs[batch_idx, anchor_idx], anchor_idx)
+        y_cls = y_cls_output[batch_idx, anchor_idx]
+        splits = np.searchsorted(batch_idx, np.arange(1, len(raw_outputs)))
 
-        bboxes = bboxes[conf_keep_idx]
-        confidences = confidences[conf_keep_idx]
+        return list(zip(np.split(y_bboxes, splits), np.split(y_cls, splits)))
 
-        pick = []
-        xmin = bboxes[:, 0]
-        ymin = bboxes[:, 1]
-        xmax = bboxes[:, 2]
-        ymax = bboxes[:, 3]
+    def img_preprocess(self,img):
+        '''
+        BGR image from cv2.imread to the normalized RGB input of the model
+        :param img: numpy array, [H,W,3], BGR
+        :return: numpy array, [model_H,model_W,3], float32
+        '''
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        img = cv2.resize(img, self.img_size)
+        img = img.astype(np.float32)
+        img /= 255
 
-        area = (xmax - xmin + 1e-3) * (ymax - ymin + 1e-3)
-        idxs = np.argsort(confidences)
+        return img
 
-        while len(idxs) > 0:
-            last = len(idxs) - 1
-            i = idxs[last]
-            pick.append(i)
+    def tile_preprocess(self,img,min_face,tile_size=None,overlap=0.25):
+        '''
+        split a large image into overlapping tiles so that small faces are not lost by the resizing.
+        A face smaller than min_anchor_size * image side can't be detected after resizing the whole image, so the
+        tiles are used only if that size is larger than min_face.
+        :param img: numpy array, [H,W,3], BGR
+        :param min_face: the min face size(pixel) to be detected
+        :param tile_size: tile side(pixel), None means min_face / min_anchor_size(at least the model input size)
+        :param overlap: overlap ratio of the neighboring tiles
+        :return: None if the tiles are not needed, otherwise (tile_data, layout).
+                 tile_data is numpy array, [num_tiles,model_H,model_W,3] processed by img_preprocess,
+                 layout is the list of [xmin, ymin, xmax, ymax](pixel) of each tile, the first one is the whole image
+        '''
+        height, width = img.shape[:2]
+        if self.min_anchor_size * max(height, width) <= min_face:
+            return None
 
-            # keep top k
-            if keep_top_k != -1:
-                if len(pick) >= keep_top_k:
-                    break
+        if tile_size is None:
+            tile_size = max(int(min_face / self.min_anchor_size), max(self.img_size))
+        tile_w = min(tile_size, width)
+        tile_h = min(tile_size, height)
+        stride_w = max(1, int(tile_w * (1 - overlap)))
+        stride_h = max(1, int(tile_h * (1 - overlap)))
+        xs = list(range(0, width - tile_w, stride_w)) + [width - tile_w]
+        ys = list(range(0, height - tile_h, stride_h)) + [height - tile_h]
 
-            overlap_xmin = np.maximum(xmin[i], xmin[idxs[:last]])
-            overlap_ymin = np.maximum(ymin[i], ymin[idxs[:last]])
-            overlap_xmax = np.minimum(xmax[i], xmax[idxs[:last]])
-            overlap_ymax = np.minimum(ymax[i], ymax[idxs[:last]])
-            overlap_w = np.maximum(0, overlap_xmax - overlap_xmin)
-            overlap_h = np.maximum(0, overlap_ymax - overlap_ymin)
-            overlap_area = overlap_w * overlap_h
-            overlap_ratio = overlap_area / (area[idxs[:last]] + area[i] - overlap_area)
+        layout = [[0, 0, width, height]]
+        for y in ys:
+            for x in xs:
+                layout.append([x, y, x + tile_w, y + tile_h])
+        tile_data = np.array([self.img_preprocess(img[ymin:ymax, xmin:xmax]) for xmin, ymin, xmax, ymax in layout])
 
-            need_to_be_deleted_idx = np.concatenate(([last], np.where(overlap_ratio > iou_thresh)[0]))
-            idxs = np.delete(idxs, need_to_be_deleted_idx)
+        return tile_data, layout
 
-        # if the number of final bboxes is less than keep_top_k, we need to pad it.
-        # TODO
-        return conf_keep_idx[pick]
+    def tile_merge(self,y_bboxes_list,y_cls_list,layout,ori_height,ori_width):
+        '''
+        map the decoded bboxes of each tile back to the whole image, post_process then does NMS across the tiles
+        :param y_bboxes_list: list of numpy array, [num_bboxes, 4], decoded bboxes of each tile
+        :param y_cls_list: list of numpy array, [num_bboxes, num_classes]
+        :param layout: tile layout from tile_preprocess
+        :return: y_bboxes [total bboxes, 4] normalized by the whole image, y_cls [total bboxes, num_classes]
+        '''
+        re_bboxes = list()
+        for y_bboxes, (xmin, ymin, xmax, ymax) in zip(y_bboxes_list, layout):
+            offset = np.array([xmin / ori_width, ymin / ori_height] * 2)
+            scale = np.array([(xmax - xmin) / ori_width, (ymax - ymin) / ori_height] * 2)
+            re_bboxes.append(y_bboxes * scale + offset)
+
+        return np.concatenate(re_bboxes, axis=0), np.concatenate(y_cls_list, axis=0)
 
     def inference(self,img_4d,ori_height,ori_width):
+        re_boxes, re_confidence, re_classes, re_mask_id = self.inference_batch(img_4d[:1], [(ori_height, ori_width)])[0]
+
+        return re_boxes, re_confidence, re_classes, re_mask_id
+
+    def inference_batch(self,img_4d,ori_sizes):
+        '''
+        inference of N images with one session run
+        :param img_4d: numpy array, [N,H,W,3], images processed by img_preprocess
+        :param ori_sizes: list of (ori_height, ori_width), one for each image
+        :return: list of (re_boxes, re_confidence, re_classes, re_mask_id), one for each image
+        '''
         # ----var
-        re_boxes = list()
-        re_confidence = list()
-        re_classes = list()
-        re_mask_id = list()
+        results = list()
 
-        y_bboxes_output, y_cls_output = self.sess.run([self.detection_bboxes, self.detection_scores],
-                                                      feed_dict={self.tf_input: img_4d})
-        # remove the batch dimension, for batch is always 1 for inference.
-        y_bboxes = self.decode_bbox(self.anchors_exp, y_bboxes_output)[0]
-        y_cls = y_cls_output[0]
-        # To speed up, do single class NMS, not multiple classes NMS.
-        bbox_max_scores = np.max(y_cls, axis=1)
-        bbox_max_score_classes = np.argmax(y_cls, axis=1)
+        selected = self.inference_selected_batch(img_4d, self.conf_thresh)
+        for (y_bboxes, y_cls), (ori_height, ori_width) in zip(selected, ori_sizes):
+            results.append(self.post_process(y_bboxes, y_cls, ori_height, ori_width))
 
-        # keep_idx is the alive bounding box after nms.
-        keep_idxs = self.single_class_non_max_suppression(y_bboxes, bbox_max_scores,  conf_thresh=self.conf_thresh,
-                                                          iou_thresh=self.iou_thresh )
-        # ====draw bounding box
-        for idx in keep_idxs:
-            conf = float(bbox_max_scores[idx])
-            #print("conf = ",conf)
-            class_id = bbox_max_score_classes[idx]
-            bbox = y_bboxes[idx]
-            #print(bbox)
+        return results
 
-            xmin = np.maximum(0, int(bbox[0] * ori_width - self.margin / 2))
-            ymin = np.maximum(0, int(bbox[1] * ori_height - self.margin / 2))
-            xmax = np.minimum(int(bbox[2] * ori_width + self.margin / 2), ori_width)
-            ymax = np.minimum(int(bbox[3] * ori_height + self.margin / 2), ori_height)
+    def inference_selected_batch(self,img_4d,score_thresh):
+        '''
+        inference of N images with one session run, only the anchors whose max class score > score_thresh are
+        decoded(NMS drops the others anyway if score_thresh <= conf_thresh)
+        :param img_4d: numpy array, [N,H,W,3], images processed by img_preprocess
+        :param score_thresh: the score floor of the decoded anchors
+        :return: list of (decoded bboxes [num_selected, 4], class scores [num_selected, num_classes])
+        '''
+        with timing(self.timer, 'sess_run'):
+            y_bboxes_output, y_cls_output = self.sess.run([self.detection_bboxes, self.detection_scores],
+                                                          feed_dict={self.tf_input: img_4d})
+        with timing(self.timer, 'decode_bbox'):
+            results = self.select_decode(y_bboxes_output, y_cls_output, score_thresh)
 
-            re_boxes.append([xmin, ymin, xmax - xmin, ymax - ymin])
-            re_confidence.append(conf)
-            re_classes.append('face')
-            re_mask_id.append(class_id)
-        return re_boxes, re_confidence, re_classes, re_mask_id
+        return results
+
+class DetectionCache():
+    def __init__(self,cache_dir,cache_thresh=None,shard=None):
+        '''
+        sidecar store of the decoded bboxes and class scores of each image, so the crops can be rebuilt with
+        another margin, conf_thresh or iou_thresh without running the model(see img_recrop).
+        detections.bin: float32 rows of [xmin, ymin, xmax, ymax, score of each class], appended image by image,
+                        it is read back as a memory-mapped array
+        detections_index.txt: path, class name, crop name, ori_height, ori_width, row offset, row quantity of each image
+        detections_meta.json: cache_thresh
+        Only the anchors whose max score > cache_thresh are stored, so the cache serves conf_thresh >= cache_thresh.
+        Each shard has its own files(detections_i_of_n*), so the processes of the shards can share the cache_dir.
+        :param cache_dir: dir of the cache files
+        :param cache_thresh: the score floor of the stored anchors(default 0.5), the one of an existing cache is used
+        :param shard: (i, n) of img_alignment, None for the unsharded cache
+        '''
+        # ----var
+        prefix = "detections" if shard is None else "detections_{}_of_{}".format(shard[0], shard[1])
+        data_path = os.path.join(cache_dir, prefix + ".bin")
+        index_path = os.path.join(cache_dir, prefix + "_index.txt")
+        meta_path = os.path.join(cache_dir, prefix + "_meta.json")
+        class_num = 2
+        rows = 0
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        # ----meta
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            if cache_thresh is not None and meta['cache_thresh'] != cache_thresh:
+                print("cache_thresh of the existing cache is used:", meta['cache_thresh'])
+            cache_thresh = meta['cache_thresh']
+            class_num = meta['class_num']
+        else:
+            if cache_thresh is None:
+                cache_thresh = 0.5
+            with open(meta_path, 'w') as f:
+                json.dump({'cache_thresh': cache_thresh, 'class_num': class_num}, f)
+
+        # ----rows recorded by the index(the rows written without index lines are dropped)
+        if os.path.exists(index_path):
+            with open(index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.endswith('\n'):
+                        splits = line[:-1].split('\t')
+                        rows = max(rows, int(splits[5]) + int(splits[6]))
+        # ----the data is written before the index line, so a data file shorter than the index is corrupted
+        data_size = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+        if data_size < rows * (4 + class_num) * 4:
+            raise ValueError("{} has {} bytes, but {} rows are recorded by {}".format(data_path, data_size, rows,
+                                                                                    index_path))
+        if os.path.exists(data_path):
+            with open(data_path, 'r+b') as f:
+                f.truncate(rows * (4 + class_num) * 4)
+
+        # ----local var to global
+        self.cache_dir = cache_dir
+        self.data_path = data_path
+        self.index_path = index_path
+        self.cache_thresh = cache_thresh
+        self.class_num = class_num
+        self.rows = rows
+        self.lock = threading.Lock()
+        self.f_data = None
+        self.f_index = None
+
+    def add(self,path,class_name,idx,ori_height,ori_width,y_bboxes,y_cls):
+        '''
+        :param y_bboxes: numpy array, [num_anchors, 4], decoded bboxes of one image
+        :param y_cls: numpy array, [num_anchors, num_classes]
+        '''
+        keep = max_class_score(y_cls) > self.cache_thresh
+        data = np.concatenate([y_bboxes[keep], y_cls[keep]], axis=1).astype(np.float32)
+        with self.lock:
+            if self.f_data is None:
+                self.f_data = open(self.data_path, 'ab')
+                self.f_index = open(self.index_path, 'a', encoding='utf-8')
+            self.f_data.write(data.tobytes())
+            self.f_data.flush()
+            self.f_index.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(path, class_name, idx, ori_height, ori_width,
+                                                                     self.rows, len(data)))
+            self.f_index.flush()
+            self.rows += len(data)
+
+    def close(self):
+        if self.f_data is not None:
+            self.f_data.close()
+            self.f_index.close()
+            self.f_data = None
+            self.f_index = None
+
+    def load(self):
+        '''
+        :return: dict of path to (class_name, crop name, ori_height, ori_width, y_bboxes, y_cls), the arrays are
+                 views of the memory-mapped data(empty if no anchor of the image is cached),
+                 the last record of a path wins
+        '''
+        re_dict = dict()
+        if not os.path.exists(self.index_path):
+            return re_dict
+
+        if self.rows == 0:#the images of the index have no anchor over cache_thresh
+            data = np.zeros([0, 4 + self.class_num], dtype=np.float32)
+        else:
+            data = np.memmap(self.data_path, dtype=np.float32, mode='r', shape=(self.rows, 4 + self.class_num))
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.endswith('\n'):
+                    path, class_name, idx, ori_height, ori_width, offset, num = line[:-1].split('\t')
+                    offset, num = int(offset), int(num)
+                    re_dict[path] = (class_name, idx, int(ori_height), int(ori_width),
+                                     data[offset:offset + num, :4], data[offset:offset + num, 4:])
+
+        return re_dict
+
+def detection_cache_shards(cache_dir):
+    '''
+    :return: shard (i, n) of each DetectionCache in cache_dir, None for the unsharded one
+    '''
+    shards = list()
+    if os.path.exists(cache_dir):
+        for name in sorted(os.listdir(cache_dir)):
+            if name == "detections_index.txt":
+                shards.append(None)
+            else:
+                match = re.match(r"detections_(\d+)_of_(\d+)_index\.txt$", name)
+                if match is not None:
+                    shards.append((int(match.group(1)), int(match.group(2))))
+
+    return shards
+
+class AlignManifest():
+    def __init__(self,manifest_path,params=None):
+        '''
+        append-only record of the processed images after the params line, one line per image:
+        path and the crops saved from it(relative to the dir of the manifest), tab separated.
+        The images recorded by the previous runs are skipped by the next run with the same params.
+        :param manifest_path: text file path
+        :param params: dict of the crop parameters(margin, thresholds, input size...), a manifest written with other
+                       params is started over and its crops are removed, so the images are cropped again
+        '''
+        # ----var
+        done = set()
+        params_line = "#" + json.dumps(params, sort_keys=True) + "\n"
+        mode = 'w'
+        root_dir = os.path.dirname(os.path.abspath(manifest_path))
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+            if len(lines) > 0 and lines[0] == params_line:
+                mode = 'a'
+                for line in lines[1:]:
+                    if line.endswith('\n'):#a line without the end is written partially
+                        done.add(line[:-1].split('\t')[0])
+                print("{} images have been processed according to {}".format(len(done), manifest_path))
+            else:
+                # ----the crops of the old params are removed, or the ones the new params don't give would be left
+                removed = 0
+                for line in lines[1:]:
+                    for crop in line.rstrip('\n').split('\t')[1:]:
+                        crop_path = os.path.join(root_dir, crop)
+                        if os.path.exists(crop_path):
+                            os.remove(crop_path)
+                            removed += 1
+                print("The crop params differ from the ones of {}, it is started over, {} old crops are removed".format(
+                    manifest_path, removed))
+
+        # ----local var to global
+        self.manifest_path = manifest_path
+        self.root_dir = root_dir
+        self.done = done
+        self.lock = threading.Lock()
+        self.f = open(manifest_path, mode, encoding='utf-8')
+        if mode == 'w':
+            self.f.write(params_line)
+            self.f.flush()
+
+    def add(self,path,crops=()):
+        '''
+        :param crops: paths of the crops saved from the image
+        '''
+        line = "\t".join([path] + [os.path.relpath(os.path.abspath(crop), self.root_dir) for crop in crops])
+        with self.lock:
+            self.f.write(line + '\n')
+            self.f.flush()
+            self.done.add(path)
+
+    def close(self):
+        self.f.close()
 
-def img_alignment(root_dir,output_dir,margin=44,GPU_ratio = 0.1,img_show=False,dataset_range=None):
+def shard_dirs(dirs,file_nums,shard):
+    '''
+    split the dirs into shard[1] shards balanced by the file quantity, a dir is never split.
+    Every process gets the same split as long as the dirs and file_nums are the same.
+    :param dirs: list of dir paths
+    :param file_nums: list of image quantity of each dir
+    :param shard: (i, n), the i-th shard(start from 0) of n shards
+    :return: the dirs of the i-th shard(sorted)
+    '''
+    shard_idx, shard_num = shard
+    if not 0 <= shard_idx < shard_num:
+        raise ValueError("shard index {} is out of range of {} shards".format(shard_idx, shard_num))
+
+    loads = [0] * shard_num
+    re_dirs = list()
+    # ----the largest dir first, to the shard with the least files
+    for idx in sorted(range(len(dirs)), key=lambda i: (-file_nums[i], i)):
+        target = int(np.argmin(loads))
+        loads[target] += file_nums[idx]
+        if target == shard_idx:
+            re_dirs.append(dirs[idx])
+    print("Shard {} of {}: {} classes, {} images".format(shard_idx, shard_num, len(re_dirs), loads[shard_idx]))
+
+    return sorted(re_dirs)
+
+def crop_names(paths):
+    '''
+    crop name of each image from its basename, so the names never depend on the other files of the dir.
+    The extension is appended to the names shared by images of different formats(e.g. a.jpg and a.png)
+    :return: list of names
+    '''
+    stems = [os.path.splitext(os.path.basename(path)) for path in paths]
+    counts = dict()
+    for stem, ext in stems:
+        counts[stem] = counts.get(stem, 0) + 1
+
+    return [stem if counts[stem] == 1 else stem + "_" + ext[1:] for stem, ext in stems]
+
+def crop_and_save(img_ori,bboxes,save_dir,idx,width_threshold,height_threshold,img_show=False,timer=None):
+    '''
+    :param idx: crop name, the crops are saved as idx_0.png, idx_1.png...
+    :return: list of the saved paths
+    '''
+    save_paths = list()
+    for num,bbox in enumerate(bboxes):
+        if bbox[2] > width_threshold and bbox[3] > height_threshold:
+            img_crop = img_ori[bbox[1]:bbox[1] + bbox[3],bbox[0]:bbox[0] + bbox[2], :]
+            save_path = os.path.join(save_dir,str(idx) + '_' + str(num) + ".png")
+            # print("save_path:",save_path)
+
+            with timing(timer, 'imwrite'):
+                cv2.imwrite(save_path,img_crop)
+            save_paths.append(save_path)
+
+            #----display images
+            if img_show is True:
+                plt.subplot(1,2,1)
+                plt.imshow(img_ori[:,:,::-1])
+
+                plt.subplot(1,2,2)
+                plt.imshow(img_crop[:,:,::-1])
+
+                plt.show()
+
+    return save_paths
+
+def img_to_input(fmd,img,min_face=None,tile_size=None,tile_overlap=0.25):
+    '''
+    :param min_face: None to disable the tiles, otherwise the tiles are used if the image is large enough for faces
+                     of min_face pixels to be lost by resizing(see FaceMaskDetection.tile_preprocess)
+    :return: the image processed by img_preprocess or (tile_data, layout)
+    '''
+    data = None
+    if min_face is not None:
+        data = fmd.tile_preprocess(img, min_face, tile_size=tile_size, overlap=tile_overlap)
+    if data is None:
+        data = fmd.img_preprocess(img)
+
+    return data
+
+def detect_batch(fmd,batch_data,batch_info,cache=None):
+    '''
+    inference of a batch, the raw detections are stored in the cache if it is given
+    :param fmd: FaceMaskDetection
+    :param batch_data: list of the outputs of img_to_input, the tiles of all images are run as one batch
+    :param batch_info: list of (img_ori, save_dir, idx, path)
+    :param cache: DetectionCache
+    :return: list of (re_boxes, re_confidence, re_classes, re_mask_id)
+    '''
+    results = list()
+    imgs = list()
+    spans = list()#(start, num, layout)
+    for data in batch_data:
+        if isinstance(data, tuple):
+            tile_data, layout = data
+            spans.append((len(imgs), len(tile_data), layout))
+            imgs.extend(tile_data)
+        else:
+            spans.append((len(imgs), 1, None))
+            imgs.append(data)
+
+    # ----only the anchors which can pass NMS or be cached are decoded
+    score_thresh = fmd.conf_thresh
+    if cache is not None:
+        score_thresh = min(score_thresh, cache.cache_thresh)
+    selected = fmd.inference_selected_batch(np.array(imgs), score_thresh)
+    if fmd.timer is not None:
+        fmd.timer.add_images(len(batch_info))
+    for (img_ori, save_dir, idx, path), (start, num, layout) in zip(batch_info, spans):
+        ori_height, ori_width = img_ori.shape[:2]
+        if layout is None:
+            y_bboxes, y_cls = selected[start]
+        else:
+            y_bboxes, y_cls = fmd.tile_merge([item[0] for item in selected[start:start + num]],
+                                             [item[1] for item in selected[start:start + num]], layout,
+                                             ori_height, ori_width)
+        if cache is not None:
+            cache.add(path, os.path.basename(save_dir), idx, ori_height, ori_width, y_bboxes, y_cls)
+        results.append(fmd.post_process(y_bboxes, y_cls, ori_height, ori_width))
+
+    return results
+
+def align_batch(fmd,tasks,batch_size,width_threshold,height_threshold,img_show=False,manifest=None,cache=None,
+                tile=False,tile_size=None,tile_overlap=0.25):
+    '''
+    read, inference and write in sequence, batch by batch
+    :param fmd: FaceMaskDetection
+    :param tasks: list of (path, save_dir, idx)
+    :param manifest: AlignManifest, the written images are added to it
+    :param cache: DetectionCache, the raw detections are added to it
+    :param tile: True to detect large images by tiles(see img_to_input)
+    :return:
+    '''
+    min_face = min(width_threshold, height_threshold) if tile is True else None
+    batch_data = list()
+    batch_info = list()#(img_ori, save_dir, idx, path)
+    for task_idx,(path,save_dir,idx) in enumerate(tasks):
+        with timing(fmd.timer, 'imread'):
+            img = cv2.imread(path)
+        if img is None:
+            print("Read failed:",path)
+        else:
+            with timing(fmd.timer, 'preprocess'):
+                data = img_to_input(fmd, img, min_face=min_face, tile_size=tile_size, tile_overlap=tile_overlap)
+            batch_data.append(data)
+            batch_info.append((img,save_dir,idx,path))
+
+        if len(batch_data) == batch_size or (task_idx == len(tasks) - 1 and len(batch_data) > 0):
+            results = detect_batch(fmd, batch_data, batch_info, cache=cache)
+            for (img_ori,save_dir_b,idx_b,path_b),(bboxes, re_confidence, re_classes, re_mask_id) in zip(batch_info,results):
+                crops = crop_and_save(img_ori, bboxes, save_dir_b, idx_b, width_threshold, height_threshold,
+                                      img_show=img_show, timer=fmd.timer)
+                if manifest is not None:
+                    manifest.add(path_b, crops)
+            batch_data = list()
+            batch_info = list()
+
+def align_pipeline(fmd,tasks,batch_size,width_threshold,height_threshold,decode_workers=4,writer_workers=2,
+                   queue_size=64,manifest=None,cache=None,tile=False,tile_size=None,tile_overlap=0.25):
+    '''
+    streaming alignment: decode threads -> detector(this thread) -> writer threads.
+    The stages are linked by bounded queues so that the memory usage is capped by queue_size images.
+    cv2.imread, cv2.imwrite and sess.run release the GIL, so the stages run concurrently.
+    :param fmd: FaceMaskDetection
+    :param tasks: list of (path, save_dir, idx)
+    :param decode_workers: threads of cv2.imread and preprocessing
+    :param writer_workers: threads of cropping and cv2.imwrite
+    :param queue_size: max items of each queue between the stages
+    :param manifest: AlignManifest, the written images are added to it
+    :param cache: DetectionCache, the raw detections are added to it
+    :param tile: True to detect large images by tiles(see img_to_input)
+    :return:
+    '''
+    # ----var
+    min_face = min(width_threshold, height_threshold) if tile is True else None
+    task_queue = queue.Queue()
+    decode_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    sentinel = None
+
+    for task in tasks:
+        task_queue.put(task)
+
+    def decode_worker():
+        try:
+            while True:
+                try:
+                    path, save_dir, idx = task_queue.get_nowait()
+                except queue.Empty:
+                    break
+                with timing(fmd.timer, 'imread'):
+                    img = cv2.imread(path)
+                if img is None:
+                    print("Read failed:", path)
+                else:
+                    with timing(fmd.timer, 'preprocess'):
+                        data = img_to_input(fmd, img, min_face=min_face, tile_size=tile_size, tile_overlap=tile_overlap)
+                    decode_queue.put((data, img, save_dir, idx, path))
+        finally:
+            decode_queue.put(sentinel)
+
+    def writer_worker():
+        while True:
+            item = write_queue.get()
+            if item is sentinel:
+                break
+            img_ori, bboxes, save_dir, idx, path = item
+            try:
+                crops = crop_and_save(img_ori, bboxes, save_dir, idx, width_threshold, height_threshold,
+                                      timer=fmd.timer)
+                if manifest is not None:
+                    manifest.add(path, crops)
+            except Exception as e:
+                print("Write failed:{}, {}".format(path, e))
+
+    decoders = [threading.Thread(target=decode_worker, daemon=True) for _ in range(decode_workers)]
+    writers = [threading.Thread(target=writer_worker, daemon=True) for _ in range(writer_workers)]
+    for thread in decoders + writers:
+        thread.start()
+
+    # ----detector stage
+    try:
+        finished = 0
+        batch_data = list()
+        batch_info = list()#(img_ori, save_dir, idx, path)
+        while finished < decode_workers:
+            item = decode_queue.get()
+            if item is sentinel:
+                finished += 1
+            else:
+                img, img_ori, save_dir, idx, path = item
+                batch_data.append(img)
+                batch_info.append((img_ori, save_dir, idx, path))
+
+            if len(batch_data) == batch_size or (finished == decode_workers and len(batch_data) > 0):
+                results = detect_batch(fmd, batch_data, batch_info, cache=cache)
+                for (img_ori, save_dir, idx, path), (bboxes, re_confidence, re_classes, re_mask_id) in zip(batch_info, results):
+                    write_queue.put((img_ori, bboxes, save_dir, idx, path))
+                batch_data = list()
+                batch_info = list()
+    finally:
+        for _ in writers:
+            write_queue.put(sentinel)
+        for thread in writers:
+            thread.join()
+
+def img_alignment(root_dir,output_dir,margin=44,GPU_ratio = 0.1,img_show=False,dataset_range=None,batch_size=16,
+                  pipeline=False,decode_workers=4,writer_workers=2,queue_size=64,shard=None,resume=True,
+                  cache_dir=None,cache_thresh=0.5,input_size=None,tile=False,tile_size=None,tile_overlap=0.25,
+                  timing_path=None,conf_thresh=0.8,iou_thresh=0.7,pre_top_k=-1):
+    '''
+    detect faces and save the crops of each class folder
+    :param pipeline: True to run decoding, inference and writing concurrently(see align_pipeline), img_show is
+                     ignored in this mode
+    :param decode_workers: threads of decoding in the pipeline mode
+    :param writer_workers: threads of writing in the pipeline mode
+    :param queue_size: max items of each queue in the pipeline mode
+    :param shard: (i, n) to work on the i-th shard(start from 0) of n shards of the classes(after dataset_range),
+                  the shards are balanced by the image quantity. Each process/machine can run one shard.
+    :param resume: True to record the processed images in a manifest file under output_dir and skip the
+                   images recorded by the previous runs with the same crop params(margin, thresholds, input size
+                   and tiles), the crops are named by the source basenames(see crop_names)
+    :param cache_dir: dir of a DetectionCache to store the raw detections, img_recrop can rebuild the crops from it
+    :param cache_thresh: the score floor of the cached anchors
+    :param input_size: input size of the face detection model, None means 260x260(see FaceMaskDetection)
+    :param tile: True to detect by overlapping tiles(plus the whole image) if the image is so large that faces of
+                 the min saved size would be lost by resizing, the boxes are merged by NMS across the tiles
+    :param tile_size: tile side(pixel), None means the largest one that keeps the min saved face detectable
+    :param tile_overlap: overlap ratio of the neighboring tiles
+    :param timing_path: JSON path to save the latency percentiles/histograms of each stage and images per second,
+                        None means no timing
+    :param conf_thresh: score threshold of the face detection
+    :param iou_thresh: IOU threshold of NMS
+    :param pre_top_k: only the pre_top_k most confident bboxes take part in NMS, -1 means all of them
+    '''
     # ----record the start time
     d_t = time.time()
     # ----var
@@ -257,6 +1074,7 @@ def img_alignment(root_dir,output_dir,margin=44,GPU_ratio = 0.1,img_show=False,d
     width_threshold = 100 + margin // 2
     height_threshold = 100 + margin // 2
     quantity = 0
+    tasks = list()#(path, save_dir, idx)
 
     # ----collect all folders
     dirs = [obj.path for obj in os.scandir(root_dir) if obj.is_dir()]
@@ -271,12 +1089,35 @@ def img_alignment(root_dir,output_dir,margin=44,GPU_ratio = 0.1,img_show=False,d
         else:
             print("Working classes:All")
 
-        #----init of face detection model
-        fmd = FaceMaskDetection(face_mask_model_path,margin,GPU_ratio)
+        # ----collect images of each dir
+        dir_paths = dict()
+        for dir_path in dirs:
+            dir_paths[dir_path] = sorted([file.path for file in os.scandir(dir_path) if file.name.split(".")[-1] in img_format])
+
+        # ----shard
+        if shard is not None:
+            dirs = shard_dirs(dirs, [len(dir_paths[dir_path]) for dir_path in dirs], shard)
+            manifest_name = "align_manifest_{}_of_{}.txt".format(shard[0], shard[1])
+        else:
+            manifest_name = "align_manifest.txt"
+
+        # ----manifest of the processed images
+        manifest = None
+        if resume is True:
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+            params = {'margin': margin, 'conf_thresh': conf_thresh, 'iou_thresh': iou_thresh, 'pre_top_k': pre_top_k,
+                      'input_size': input_size, 'tile': tile, 'tile_size': tile_size, 'tile_overlap': tile_overlap}
+            manifest = AlignManifest(os.path.join(output_dir, manifest_name), params=params)
 
-        # ----handle images of each dir
+        # ----sidecar cache of the raw detections
+        cache = None
+        if cache_dir is not None:
+            cache = DetectionCache(cache_dir, cache_thresh=cache_thresh, shard=shard)
+
+        # ----tasks of each dir(a batch can span dir boundaries)
         for dir_path in dirs:
-            paths = [file.path for file in os.scandir(dir_path) if file.name.split(".")[-1] in img_format]
+            paths = dir_paths[dir_path]
             if len(paths) == 0:
                 print("No images in ",dir_path)
             else:
@@ -285,39 +1126,35 @@ def img_alignment(root_dir,output_dir,margin=44,GPU_ratio = 0.1,img_show=False,d
                 if not os.path.exists(save_dir):
                     os.makedirs(save_dir)
 
-                #----
-                quantity += len(paths)
-                for idx,path in enumerate(paths):
-                    img = cv2.imread(path)
-                    if img is None:
-                        print("Read failed:",path)
-                    else:
-                        ori_height,ori_width = img.shape[:2]
-                        img_ori = img.copy()
-                        img = cv2.cvtColor(img,cv2.COLOR_BGR2RGB)
-                        img = cv2.resize(img,fmd.img_size)
-                        img = img.astype(np.float32)
-                        img /= 255
-                        img_4d = np.expand_dims(img,axis=0)
-                        bboxes, re_confidence, re_classes, re_mask_id = fmd.inference(img_4d,ori_height,ori_width)
-
-                        for num,bbox in enumerate(bboxes):
-                            if bbox[2] > width_threshold and bbox[3] > height_threshold:
-                                img_crop = img_ori[bbox[1]:bbox[1] + bbox[3],bbox[0]:bbox[0] + bbox[2], :]
-                                save_path = os.path.join(save_dir,str(idx) + '_' + str(num) + ".png")
-                                # print("save_path:",save_path)
-
-                                cv2.imwrite(save_path,img_crop)
-
-                                #----display images
-                                if img_show is True:
-                                    plt.subplot(1,2,1)
-                                    plt.imshow(img_ori[:,:,::-1])
-
-                                    plt.subplot(1,2,2)
-                                    plt.imshow(img_crop[:,:,::-1])
-
-                                    plt.show()
+                #----the crop names come from the basenames, they stay the same after files are added
+                for idx,path in zip(crop_names(paths),paths):
+                    if manifest is None or path not in manifest.done:
+                        tasks.append((path,save_dir,idx))
+        quantity = len(tasks)
+        print("Images to process: ", quantity)
+
+        #----init of face detection model
+        fmd = FaceMaskDetection(face_mask_model_path,margin,GPU_ratio,conf_thresh=conf_thresh,iou_thresh=iou_thresh,
+                                input_size=input_size,pre_top_k=pre_top_k)
+        if timing_path is not None:
+            fmd.timer = StageTimer()
+
+        # ----batch inference
+        try:
+            if pipeline is True:
+                align_pipeline(fmd, tasks, batch_size, width_threshold, height_threshold, decode_workers=decode_workers,
+                               writer_workers=writer_workers, queue_size=queue_size, manifest=manifest, cache=cache,
+                               tile=tile, tile_size=tile_size, tile_overlap=tile_overlap)
+            else:
+                align_batch(fmd, tasks, batch_size, width_threshold, height_threshold, img_show=img_show,
+                            manifest=manifest, cache=cache, tile=tile, tile_size=tile_size, tile_overlap=tile_overlap)
+        finally:
+            if manifest is not None:
+                manifest.close()
+            if cache is not None:
+                cache.close()
+            if fmd.timer is not None:
+                fmd.timer.report(json_path=timing_path)
 
     # ----statistics(to know the average process time of each image)
     if quantity != 0:
@@ -326,6 +1163,171 @@ def img_alignment(root_dir,output_dir,margin=44,GPU_ratio = 0.1,img_show=False,d
 
 
 
+def img_recrop(cache_dir,output_dir,margin=44,conf_thresh=0.8,iou_thresh=0.7,workers=4,pre_top_k=-1):
+    '''
+    rebuild the crops from the DetectionCache(all shards) written by img_alignment, the model is not loaded
+    :param cache_dir: dir of the DetectionCache
+    :param output_dir: the crops of each class are saved in output_dir/class name
+    :param conf_thresh: should be >= cache_thresh of the cache
+    :param workers: threads of reading and writing images
+    :param pre_top_k: only the pre_top_k most confident bboxes take part in NMS, -1 means all of them
+    '''
+    # ----record the start time
+    d_t = time.time()
+    # ----var
+    width_threshold = 100 + margin // 2
+    height_threshold = 100 + margin // 2
+    records = dict()
+
+    for shard in detection_cache_shards(cache_dir):
+        cache = DetectionCache(cache_dir, shard=shard)
+        if conf_thresh < cache.cache_thresh:
+            print("Warning: conf_thresh {} is lower than cache_thresh {}, anchors under cache_thresh are not cached".format(
+                conf_thresh, cache.cache_thresh))
+        records.update(cache.load())
+    quantity = len(records)
+    print("Cached images: ", quantity)
+
+    if quantity > 0:
+        # ----NMS and box scaling only, no session
+        fmd = BoxPostProcess(margin=margin, conf_thresh=conf_thresh, iou_thresh=iou_thresh, pre_top_k=pre_top_k)
+
+        for class_name in set([record[0] for record in records.values()]):
+            save_dir = os.path.join(output_dir, class_name)
+            if not os.path.exists(save_dir):
+                os.makedirs(save_dir)
+
+        def recrop(item):
+            path, (class_name, idx, ori_height, ori_width, y_bboxes, y_cls) = item
+            bboxes, re_confidence, re_classes, re_mask_id = fmd.post_process(np.array(y_bboxes), np.array(y_cls),
+                                                                            ori_height, ori_width)
+            if len(bboxes) > 0:
+                img = cv2.imread(path)
+                if img is None:
+                    print("Read failed:", path)
+                else:
+                    crop_and_save(img, bboxes, os.path.join(output_dir, class_name), idx, width_threshold,
+                                  height_threshold)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(recrop, records.items()))
+
+        # ----statistics(to know the average process time of each image)
+        d_t = time.time() - d_t
+        print("ave process time of each image:", d_t / quantity)
+
+
+
+class TemplateTracker():
+    def __init__(self,search_ratio=0.5,track_scale=0.5):
+        '''
+        cheap tracker of the detected bboxes by template matching(TM_CCOEFF_NORMED) on a downscaled gray frame.
+        The templates are taken at the last detection, so the score drops when the faces change or move away.
+        :param search_ratio: the search window is the bbox expanded by search_ratio of its width/height on each side
+        :param track_scale: scale of the gray frame used for tracking
+        '''
+        self.search_ratio = search_ratio
+        self.track_scale = track_scale
+        self.templates = list()#(template, [x, y, w, h] in the scaled frame), template is None if the bbox is too small
+
+    def to_gray(self,frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, None, fx=self.track_scale, fy=self.track_scale, interpolation=cv2.INTER_AREA)
+
+    def init(self,frame,bboxes):
+        '''
+        :param frame: BGR frame
+        :param bboxes: list of [x, y, w, h] in the frame, the bboxes too small to track keep their place in the list
+                       with score 0 in update(), so the caller detects again instead of mixing up the faces
+        '''
+        gray = self.to_gray(frame)
+        self.templates = list()
+        for bbox in bboxes:
+            x, y, w, h = [int(round(v * self.track_scale)) for v in bbox]
+            if w >= 4 and h >= 4:
+                self.templates.append((gray[y:y + h, x:x + w].copy(), [x, y, w, h]))
+            else:
+                self.templates.append((None, [x, y, w, h]))
+
+    def update(self,frame):
+        '''
+        :param frame: BGR frame
+        :return: bboxes([x, y, w, h] in the frame) and the matching score of each bbox
+        '''
+        gray = self.to_gray(frame)
+        height, width = gray.shape[:2]
+        re_boxes = list()
+        re_scores = list()
+        for idx, (template, (x, y, w, h)) in enumerate(self.templates):
+            dx = int(w * self.search_ratio)
+            dy = int(h * self.search_ratio)
+            x_s = max(0, x - dx)
+            y_s = max(0, y - dy)
+            window = gray[y_s:min(height, y + h + dy), x_s:min(width, x + w + dx)]
+            if template is None or window.shape[0] < h or window.shape[1] < w:
+                re_boxes.append([int(v / self.track_scale) for v in (x, y, w, h)])
+                re_scores.append(0.0)
+                continue
+            result = cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED)
+            _, score, _, loc = cv2.minMaxLoc(result)
+            x, y = x_s + loc[0], y_s + loc[1]
+            self.templates[idx] = (template, [x, y, w, h])
+            re_boxes.append([int(v / self.track_scale) for v in (x, y, w, h)])
+            re_scores.append(float(score))
+
+        return re_boxes, re_scores
+
+def video_detection(fmd,source,detect_interval=5,track_thresh=0.6,search_ratio=0.5,track_scale=0.5):
+    '''
+    face mask detection of a video file or a camera. The model runs every detect_interval frames or when the tracking
+    score of any bbox is lower than track_thresh, the bboxes of the other frames come from TemplateTracker.
+    :param fmd: FaceMaskDetection
+    :param source: video path or camera index of cv2.VideoCapture
+    :param detect_interval: run the model at least once every detect_interval frames
+    :param track_thresh: the min matching score to keep tracking
+    :return: generator of (frame index, frame, bboxes, confidences, mask ids, detected), the confidences of the
+             tracked frames are the ones of the last detection, detected is True if the model ran on the frame
+    '''
+    # ----var
+    tracker = TemplateTracker(search_ratio=search_ratio, track_scale=track_scale)
+    frame_idx = 0
+    last_detect = None
+    re_confidence = list()
+    re_mask_id = list()
+
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        print("Open failed:", source)
+    else:
+        try:
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+
+                # ----track first, detect if it is time to or the tracking is lost
+                detected = False
+                if last_detect is None or frame_idx - last_detect >= detect_interval:
+                    detected = True
+                else:
+                    bboxes, scores = tracker.update(frame)
+                    if len(scores) > 0 and min(scores) < track_thresh:
+                        detected = True
+
+                if detected is True:
+                    ori_height, ori_width = frame.shape[:2]
+                    img_4d = np.expand_dims(fmd.img_preprocess(frame), axis=0)
+                    bboxes, re_confidence, re_classes, re_mask_id = fmd.inference(img_4d, ori_height, ori_width)
+                    tracker.init(frame, bboxes)
+                    last_detect = frame_idx
+
+                yield frame_idx, frame, bboxes, re_confidence, re_mask_id, detected
+                frame_idx += 1
+        finally:
+            cap.release()
+
+
+
 if __name__ == "__main__":
     #----alignment
     root_dir = r"C:\Users\aarya\OneDrive\Desktop\my"
@@ -334,4 +1336,27 @@ if __name__ == "__main__":
     GPU_ratio = 0.4
     img_show = False
     dataset_range = [0,1]
-    img_alignment(root_dir, output_dir, margin=margin, GPU_ratio=GPU_ratio, img_show=img_show,dataset_range=dataset_range)
\ No newline at end of file
+    batch_size = 16
+    pipeline = True
+    shard = None#(0,4) for the 1st of 4 processes
+    cache_dir = None#set a dir to use img_recrop later
+    input_size = None#160 or 192 for images with one large face
+    tile = False#True for 4K images with small faces
+    timing_path = None#a JSON path to save the latency of each stage
+    img_alignment(root_dir, output_dir, margin=margin, GPU_ratio=GPU_ratio, img_show=img_show,dataset_range=dataset_range,
+                  batch_size=batch_size, pipeline=pipeline, shard=shard, cache_dir=cache_dir, input_size=input_size,
+                  tile=tile, timing_path=timing_path)
+
+    #----rebuild crops from the detection cache
+    # cache_dir = r"C:\Users\aarya\OneDrive\Desktop\my-cache"
+    # img_recrop(cache_dir, output_dir, margin=margin, conf_thresh=0.8, iou_thresh=0.7)
+
+    #----video or camera detection
+    # fmd = FaceMaskDetection(r'face_mask_detection.pb', margin=0, GPU_ratio=GPU_ratio)
+    # for frame_idx, frame, bboxes, re_confidence, re_mask_id, detected in video_detection(fmd, 0, detect_interval=5):
+    #     for bbox, mask_id in zip(bboxes, re_mask_id):
+    #         color = (0, 255, 0) if mask_id == 0 else (0, 0, 255)
+    #         cv2.rectangle(frame, (bbox[0], bbox[1]), (bbox[0] + bbox[2], bbox[1] + bbox[3]), color, 2)
+    #     cv2.imshow("face mask detection", frame)
+    #     if cv2.waitKey(1) & 0xFF == ord('q'):
+    #         break
@@ -162,6 +162,7 @@ class Facenet():
         GPU_ratio = para_dict['GPU_ratio']
         batch_size = para_dict['batch_size']
         ratio=para_dict['ratio']
+        mask_ratio = para_dict.get('mask_ratio', 0)#fraction of each training batch wearing face masks
 
 
         #----local var
@@ -183,6 +184,11 @@ class Facenet():
         else:
             img_quantity = self.train_paths.shape[0]
 
+        #----on-the-fly face mask augmentation
+        if mask_ratio > 0:
+            self.mask_aug_init(para_dict.get('mask_img_dir', "mask_img"), template=para_dict.get('mask_template'),
+                               landmark_dir=para_dict.get('landmark_dir'))
+
         #----calculate iterations of one epoch
         train_ites = math.ceil(self.train_paths.shape[0] / batch_size)
         # if self.test_img_dir is not None:
@@ -233,7 +239,8 @@ class Facenet():
 
 
                     #d_t_2 = time.time()
-                    batch_data = self.get_4D_data(self.train_paths[num_start:num_end],self.model_shape[1:])
+                    batch_data = self.get_4D_data(self.train_paths[num_start:num_end],self.model_shape[1:],
+                                                  mask_ratio=mask_ratio)
                     #rint("Batch data process time:", d_t_2)
 
                     #----put all data to tf placeholders
@@ -364,15 +371,89 @@ class Facenet():
 
         return count
 
-    def get_4D_data(self,paths,img_shape):
+    def mask_aug_init(self,mask_img_dir,template=None,landmark_dir=None):
+        '''
+        face mask augmentation replaces the offline masked copy of the training set(mask_wearing)
+        :param mask_img_dir: dir of face mask PNG images
+        :param template: normalized (x_min, y_min, x_max, y_max) of the mouth part(see mask_wear_class.template_mouth),
+                         used for the images without cached landmarks
+        :param landmark_dir: dir of LandmarkCache made by mask_wearing, the mouth parts of the training images
+        '''
+        from mask_wear_class import MaskAssetCache, LandmarkCache#dlib is only needed with the augmentation
+
+        # ----var
+        mouth_dict = dict()
+
+        mask_cache = MaskAssetCache(mask_img_dir, size_step=4)
+        if mask_cache.mask_num == 0:
+            print("Error: no face mask PNG images in  ", mask_img_dir)
+
+        # ----mouth parts of the training images(in the original image coordinates)
+        if landmark_dir is not None:
+            landmark_cache = LandmarkCache(landmark_dir)
+            for path in self.train_paths:
+                mouth = landmark_cache.get(path, os.stat(path).st_mtime_ns)
+                if mouth is not None and mouth[2] is not None:
+                    mouth_dict[path] = mouth
+        print("face mask augmentation, mask number:{}, images with cached mouth parts:{}, template:{}".format(
+            mask_cache.mask_num, len(mouth_dict), template))
+
+        # ----local var to global
+        self.mask_cache = mask_cache
+        self.mouth_dict = mouth_dict
+        self.mask_template = template
+
+    def mask_augment(self,img,path,ori_shape):
+        '''
+        put a random face mask on the resized image
+        :param img: resized BGR image, modified in place
+        :param path: image path, the key of the cached mouth part
+        :param ori_shape: shape of the image before resizing
+        :return: img, not masked if no mouth part is available
+        '''
+        from mask_wear_class import template_mouth, wear_mask
+
+        if self.mask_cache.mask_num == 0:
+            return img
+
+        mouth = self.mouth_dict.get(path)
+        if mouth is not None:
+            x_ratio = img.shape[1] / ori_shape[1]
+            y_ratio = img.shape[0] / ori_shape[0]
+            x_min = int(mouth[0] * x_ratio)
+            y_min = int(mouth[1] * y_ratio)
+            size = (min(int(mouth[2][0] * x_ratio), img.shape[1] - x_min),
+                    min(int(mouth[2][1] * y_ratio), img.shape[0] - y_min))
+        elif self.mask_template is not None:
+            x_min, y_min, size = template_mouth(img.shape, self.mask_template)
+        else:
+            return img
+
+        if size[0] > 0 and size[1] > 0:
+            wear_mask(img, x_min, y_min, size, self.mask_cache, np.random.randint(self.mask_cache.mask_num))
+
+        return img
+
+    def get_4D_data(self,paths,img_shape,mask_ratio=0):
+        '''
+        :param mask_ratio: fraction of the images wearing face masks(see mask_aug_init), 0 means no augmentation
+        '''
         re_array = []
+        mask_indice = set()
+
+        if mask_ratio > 0:
+            mask_num = int(round(len(paths) * mask_ratio))
+            mask_indice = set(np.random.choice(len(paths), mask_num, replace=False))
 
-        for path in paths:
+        for idx, path in enumerate(paths):
             img = cv2.imread(path)
             if img is None:
                 print("read failed:",path)
             else:
+                ori_shape = img.shape
                 img = cv2.resize(img,(img_shape[1],img_shape[0]))
+                if idx in mask_indice:
+                    img = self.mask_augment(img, path, ori_shape)
                 img = cv2.cvtColor(img,cv2.COLOR_BGR2RGB)
                 img = img.astype(np.float32)
                 img /= 255
@@ -543,8 +624,9 @@ class Facenet():
 
 
 if __name__ == "__main__":
-    train_img_dir = [r"C:\Users\aarya\Downloads\CASIA-WebFace\cropped faces",
-                      r"C:\Users\aarya\Downloads\CASIA-WebFace\cropped faces mask"]
+    train_img_dir = r"C:\Users\aarya\Downloads\CASIA-WebFace\cropped faces"
+    # train_img_dir = [r"C:\Users\aarya\Downloads\CASIA-WebFace\cropped faces",
+    #                   r"C:\Users\aarya\Downloads\CASIA-WebFace\cropped faces mask"]#offline masked copy
     test_img_dir = r"C:\Users\aarya\Downloads\LFW_aligned\detect_aligned"
 
     label_dict = None
@@ -576,6 +658,17 @@ if __name__ == "__main__":
     '''
     batch_size = 32
     ratio = 0.002#1.0#0.002
-    para_dict = {'epochs':epochs, "GPU_ratio":GPU_ratio, "batch_size":batch_size,"ratio":ratio}
+    '''
+    face mask augmentation instead of the offline masked copy(mask_wearing) of the training set:
+    mask_ratio of each batch wears face masks, the mouth parts come from the landmark cache of mask_wearing
+    or the template(aligned crops)
+    '''
+    mask_ratio = 0.5#0 means no augmentation
+    mask_img_dir = r"mask_img"
+    mask_template = (0.12,0.48,0.88,0.98)
+    landmark_dir = None#r"C:\Users\aarya\Downloads\CASIA-WebFace\landmark cache"
+    para_dict = {'epochs':epochs, "GPU_ratio":GPU_ratio, "batch_size":batch_size,"ratio":ratio,
+                 "mask_ratio":mask_ratio,"mask_img_dir":mask_img_dir,"mask_template":mask_template,
+                 "landmark_dir":landmark_dir}
 
     cls.train(para_dict)
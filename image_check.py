@@ -1,36 +1,216 @@
-import os,cv2
+import os,cv2,struct,multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 img_format = {'png' ,'jpg','bmp'}
 
-def image_check(root_dir):
+#----decode flags of the check modes, fast: JPEG is decoded at 1/8 scale
+decode_flags = {'full': cv2.IMREAD_COLOR, 'fast': cv2.IMREAD_REDUCED_COLOR_8}
+
+
+def find_from_end(f,token,start,file_size,chunk_size=4096):
+    '''
+    search token backwards chunk by chunk, so data appended after the end marker is allowed
+    :param start: the search doesn't go before this position
+    :return: True if token is found
+    '''
+    end = file_size
+    while end > start:
+        pos = max(end - chunk_size, start)
+        f.seek(pos)
+        if token in f.read(end - pos + len(token) - 1):#overlap the next chunk for a token across the chunks
+            return True
+        end = pos
+
+    return False
+
+
+def read_header(img_path):
+    '''
+    read the size from the header and check the end of JPEG, PNG and BMP files without decoding
+    :return: status('ok', 'unreadable', 'truncated', 'unknown': not JPEG, PNG or BMP), height, width(None if unknown)
+    '''
+    height, width = None, None
+    try:
+        with open(img_path, 'rb') as f:
+            head = f.read(26)
+            f.seek(0, os.SEEK_END)
+            file_size = f.tell()
+
+            if head[:2] == b'\xff\xd8':#JPEG, walk the segments to the SOF marker
+                f.seek(2)
+                while True:
+                    byte = f.read(1)
+                    if byte != b'\xff':
+                        return 'truncated', height, width
+                    while byte == b'\xff':#fill bytes before the marker are legal
+                        byte = f.read(1)
+                    if len(byte) == 0:
+                        return 'truncated', height, width
+                    marker = byte[0]
+                    if 0xd0 <= marker <= 0xd7 or marker == 0x01:#markers without a length
+                        continue
+                    length = f.read(2)
+                    if len(length) < 2:
+                        return 'truncated', height, width
+                    if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                        height, width = struct.unpack('>HH', f.read(5)[1:5])
+                        break
+                    f.seek(struct.unpack('>H', length)[0] - 2, os.SEEK_CUR)
+                if not find_from_end(f, b'\xff\xd9', f.tell(), file_size):#EOI, the thumbnails are before SOF
+                    return 'truncated', height, width
+            elif head[:8] == b'\x89PNG\r\n\x1a\n':
+                width, height = struct.unpack('>II', head[16:24])
+                if not find_from_end(f, b'IEND', 33, file_size):
+                    return 'truncated', height, width
+            elif head[:2] == b'BM':
+                width, height = struct.unpack('<ii', head[18:26])
+                height = abs(height)
+                if file_size < struct.unpack('<I', head[2:6])[0]:
+                    return 'truncated', height, width
+            else:
+                return 'unknown', height, width
+    except (OSError, struct.error):
+        return 'unreadable', height, width
+
+    return 'ok', height, width
+
+
+def check_one(img_path,mode='full',min_size=0):
+    '''
+    :param mode: 'full': full decode, 'fast': reduced decode(cv2.IMREAD_REDUCED_COLOR_8), 'header': no decode.
+                 In 'full' and 'fast' mode, a header 'ok' image that cv2 can't decode is unreadable, the 'truncated'
+                 ones stay truncated even if cv2 decodes them(it fills the missing part).
+                 The formats cv2 reads other than JPEG, PNG and BMP are always decoded(in full size) and judged by it
+    :param min_size: images whose height or width < min_size are undersized
+    :return: img_path, status('ok', 'unreadable', 'truncated', 'undersized'), height, width
+    '''
+    status, height, width = read_header(img_path)
+    if mode != 'header' or status == 'unknown':
+        flags = decode_flags.get(mode, cv2.IMREAD_COLOR) if height is not None else cv2.IMREAD_COLOR
+        img = cv2.imread(img_path, flags)
+        if img is None:
+            if status in ('ok', 'unknown'):
+                status = 'unreadable'
+        elif status == 'unknown':
+            status = 'ok'
+            if height is None:
+                height, width = img.shape[:2]
+    if status == 'ok' and height is not None and min(height, width) < min_size:
+        status = 'undersized'
+
+    return img_path, status, height, width
+
+
+def scan_dir(dir_path):
+    '''
+    :return: sub dir paths, image paths
+    '''
+    dirs = list()
+    paths = list()
+    try:
+        for obj in os.scandir(dir_path):
+            if obj.is_dir():
+                dirs.append(obj.path)
+            elif obj.name.split(".")[-1] in img_format:
+                paths.append(obj.path)
+    except OSError as e:
+        print("Read failed:", dir_path, e)
+
+    return dirs, paths
+
+
+def parallel_walk(root_dir,workers=8):
+    '''
+    walk the tree level by level, the dirs of each level are listed by a thread pool
+    :return: sorted image paths
+    '''
+    paths = list()
+    dirs = [root_dir]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while len(dirs) > 0:
+            next_dirs = list()
+            for sub_dirs, sub_paths in executor.map(scan_dir, dirs):
+                next_dirs.extend(sub_dirs)
+                paths.extend(sub_paths)
+            dirs = next_dirs
+    paths.sort()
+
+    return paths
+
+
+def read_report(report_path):
+    '''
+    :return: dict of img_path to status, partial lines are skipped
+    '''
+    results = dict()
+    if os.path.exists(report_path):
+        with open(report_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.endswith('\n'):
+                    splits = line[:-1].split('\t')
+                    results[splits[0]] = splits[1]
+
+    return results
+
+
+def image_check(root_dir,report_path=None,mode='full',min_size=0,workers=None,walk_workers=8,chunk_size=64):
+    '''
+    check if each image is readable with a process pool
+    :param report_path: tab-separated report(img_path, status, height, width), the images in it are skipped,
+                        so an interrupted check can be resumed. None: no report
+    :param mode: 'full': full decode, 'fast': reduced decode(cv2.IMREAD_REDUCED_COLOR_8), 'header': no decode.
+                 The header(size, end of the file) is checked without decoding in 'header' mode only,
+                 in the other modes cv2 decides if an image is readable.
+    :param min_size: images whose height or width < min_size are reported as undersized
+    :param workers: number of worker processes, None means the CPU count
+    :param walk_workers: threads of listing dirs
+    :param chunk_size: images of each worker task
+    '''
     qty = 0
-    error_count = 0
+    counts = dict()
+    done = dict()
     if not os.path.exists(root_dir):
         print("Error:root dir doesn't exist:",root_dir)
+    elif mode not in ('full', 'fast', 'header'):
+        print("Error:unknown mode:", mode)
     else:
-        for dir_path,sub_dir,filename_list in os.walk(root_dir):
-            if len(filename_list) > 0:
-                for filename in filename_list:
+        paths = parallel_walk(root_dir, workers=walk_workers)
+        if report_path is not None:
+            done = read_report(report_path)
+            paths = [path for path in paths if path not in done]
+        for status in done.values():
+            counts[status] = counts.get(status, 0) + 1
+        print("image quantity: {}, checked before: {}, mode: {}".format(len(paths) + len(done), len(done), mode))
+
+        f_report = None if report_path is None else open(report_path, 'a', encoding='utf-8')
+        try:
+            with multiprocessing.Pool(workers) as pool:
+                for img_path, status, height, width in pool.imap_unordered(
+                        partial(check_one, mode=mode, min_size=min_size), paths, chunksize=chunk_size):
                     if qty > 0 and qty % 5000 == 0:
                         print("have processed {} images".format(qty))
-
-                    if filename.split(".")[-1] in img_format:
-                        img_path = os.path.join(dir_path,filename)
-                        # print("img_path:",img_path)
-
-                        img = cv2.imread(img_path)
-                        qty += 1
-                        if img is None:
-                            print("Read failed:",img_path)
-                            error_count += 1
+                    qty += 1
+                    counts[status] = counts.get(status, 0) + 1
+                    if status != 'ok':
+                        print("{}:".format(status), img_path)
+                    if f_report is not None:
+                        f_report.write("{}\t{}\t{}\t{}\n".format(img_path, status, height, width))
+                        if status != 'ok':
+                            f_report.flush()
+        finally:
+            if f_report is not None:
+                f_report.close()
 
         #----
-        print("image quantity: {}, error count: {}".format(qty,error_count))
+        total = qty + len(done)
+        print("image quantity: {}, error count: {}, {}".format(total, total - counts.get('ok', 0), counts))
 
 
 
 if __name__ == "__main__":
     root_dir = r"F:\dataset\FLW_detect_aligned"
-    image_check(root_dir)#this function is used to exam if each image can be readable.
+    report_path = r"F:\dataset\FLW_detect_aligned_check.txt"
+    image_check(root_dir,report_path=report_path,mode='fast',min_size=32)#this function is used to exam if each image can be readable.
 
 
 
@@ -1,18 +1,208 @@
-import os,cv2,random
+import os,cv2,random,zlib,multiprocessing
+from collections import OrderedDict
 import numpy as np
 import dlib#I use the version of 19.19.0. Use pip install dlib
 
 print("dlib version: ",dlib.__version__)
 
-def detect_mouth(img,detector,predictor):
+class MaskAssetCache():
+    def __init__(self,mask_img_dir,alpha_thresh=220,size_step=8,max_variants=256):
+        '''
+        decode all face mask PNG images once and keep the resized variants in a LRU
+        :param mask_img_dir: dir of face mask PNG images(with alpha channel)
+        :param alpha_thresh: alpha values above it belong to the face mask
+        :param size_step: target sizes are quantized(floored) to the multiple of size_step, 1 for the exact size
+        :param max_variants: max number of resized variants in the LRU
+        '''
+        # ----var
+        item_imgs = list()
+        item_masks = list()
+        item_bgrs = list()
+        loaded_files = list()
+
+        # ----read mask png images
+        mask_files = [file.path for file in os.scandir(mask_img_dir) if file.name.split(".")[-1] == 'png']
+        mask_files.sort()
+        for mask_file in mask_files:
+            item_img = cv2.imread(mask_file, cv2.IMREAD_UNCHANGED)
+            if item_img is None or item_img.ndim != 3 or item_img.shape[-1] != 4:
+                print("Read failed(BGRA PNG is needed):", mask_file)
+            else:
+                _, item_mask = cv2.threshold(item_img[:, :, 3], alpha_thresh, 255, cv2.THRESH_BINARY)
+                loaded_files.append(mask_file)
+                item_imgs.append(item_img)
+                item_masks.append(item_mask)
+                item_bgrs.append(cv2.bitwise_and(item_img[:, :, :3], item_img[:, :, :3], mask=item_mask))
+
+        # ----local var to global
+        self.mask_files = loaded_files
+        self.item_imgs = item_imgs
+        self.item_masks = item_masks#binary masks of the original size
+        self.item_bgrs = item_bgrs#masked BGR layers of the original size
+        self.mask_num = len(item_imgs)
+        self.alpha_thresh = alpha_thresh
+        self.size_step = max(int(size_step), 1)
+        self.max_variants = max_variants
+        self.variants = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def quantize(self,size):
+        '''
+        :param size: (width,height)
+        :return: quantized (width,height), never larger than size
+        '''
+        q_size = list()
+        for length in size:
+            length = int(length)
+            if length >= self.size_step:
+                length = length // self.size_step * self.size_step
+            q_size.append(length)
+
+        return tuple(q_size)
+
+    def get(self,which,size):
+        '''
+        get the face mask resized to the quantized size
+        :param which: index of the face mask
+        :param size: target (width,height)
+        :return: masked BGR layer [h,w,3], binary mask(0 or 255) [h,w], BGR layer [h,w,3], alpha [h,w,1],
+                 all of the quantized size, see composite
+        '''
+        key = (which, self.quantize(size))
+        variant = self.variants.get(key)
+        if variant is None:
+            self.misses += 1
+            item_img = cv2.resize(self.item_imgs[which], key[1])
+            item_img_bgr = item_img[:, :, :3]
+            item_alpha = item_img[:, :, 3:]
+            _, item_mask = cv2.threshold(item_alpha, self.alpha_thresh, 255, cv2.THRESH_BINARY)
+            img_item = cv2.bitwise_and(item_img_bgr, item_img_bgr, mask=item_mask)
+            variant = (img_item, item_mask, item_img_bgr, item_alpha)
+            self.variants[key] = variant
+            if len(self.variants) > self.max_variants:
+                self.variants.popitem(last=False)
+        else:
+            self.hits += 1
+            self.variants.move_to_end(key)
+
+        return variant
+
+
+class LandmarkCache():
+    def __init__(self,cache_dir):
+        '''
+        on-disk store of the mouth part of each image, so mask synthesis doesn't run the face detection and
+        the landmarks again until the image changes.
+        landmarks.bin: int32 rows of the 20 mouth landmarks(x0, y0, x1, y1, ...), appended image by image
+        landmarks_index.txt: path, mtime(ns), x_min, y_min, width, height, row of each image,
+                             width, height and row are -1 if no mouth is found
+        :param cache_dir: dir of the cache files
+        '''
+        # ----var
+        data_path = os.path.join(cache_dir, "landmarks.bin")
+        index_path = os.path.join(cache_dir, "landmarks_index.txt")
+        records = dict()
+        rows = 0
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        # ----records of the index(the last record of a path wins), rows written without index lines are dropped
+        if os.path.exists(index_path):
+            with open(index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.endswith('\n'):
+                        path, mtime, x_min, y_min, width, height, row = line[:-1].split('\t')
+                        records[path] = (int(mtime), int(x_min), int(y_min), int(width), int(height), int(row))
+                        rows = max(rows, int(row) + 1)
+        # ----the data is written before the index line, so a data file shorter than the index is corrupted
+        data_size = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+        if data_size < rows * 40 * 4:
+            raise ValueError("{} has {} bytes, but {} rows are recorded by {}".format(data_path, data_size, rows,
+                                                                                    index_path))
+        if os.path.exists(data_path):
+            with open(data_path, 'r+b') as f:
+                f.truncate(rows * 40 * 4)
+
+        # ----local var to global
+        self.cache_dir = cache_dir
+        self.data_path = data_path
+        self.index_path = index_path
+        self.records = records
+        self.rows = rows
+        self.f_data = None
+        self.f_index = None
+        self.data = None
+
+    def get(self,path,mtime):
+        '''
+        :return: None if the image isn't cached or it's changed, else (x_min, y_min, size), size is None if no mouth
+        '''
+        record = self.records.get(path)
+        if record is None or record[0] != mtime:
+            return None
+        if record[5] < 0:
+            return (None, None, None)
+
+        return (record[1], record[2], (record[3], record[4]))
+
+    def landmarks(self,path):
+        '''
+        :return: numpy array, [20, 2], the mouth landmarks of the image, None if it isn't cached or has no mouth
+        '''
+        record = self.records.get(path)
+        if record is None or record[5] < 0:
+            return None
+        if self.data is None or len(self.data) <= record[5]:
+            self.data = np.memmap(self.data_path, dtype=np.int32, mode='r', shape=(self.rows, 20, 2))
+
+        return self.data[record[5]]
+
+    def add(self,path,mtime,x_min,y_min,size,points):
+        '''
+        :param size: (width,height), None if no mouth is found
+        :param points: list of the 20 mouth landmarks (x,y), None if no mouth is found
+        '''
+        if self.f_data is None:
+            self.f_data = open(self.data_path, 'ab')
+            self.f_index = open(self.index_path, 'a', encoding='utf-8')
+        if size is None:
+            x_min, y_min, width, height, row = -1, -1, -1, -1, -1
+        else:
+            width, height = size
+            row = self.rows
+            self.f_data.write(np.array(points, dtype=np.int32).tobytes())
+            self.f_data.flush()
+            self.rows += 1
+        self.f_index.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(path, mtime, int(x_min), int(y_min), int(width),
+                                                                 int(height), row))
+        self.f_index.flush()
+        self.records[path] = (mtime, int(x_min), int(y_min), int(width), int(height), row)
+
+    def close(self):
+        if self.f_data is not None:
+            self.f_data.close()
+            self.f_index.close()
+            self.f_data = None
+            self.f_index = None
+
+
+def detect_mouth_points(img,detector,predictor,faces=None):
+    '''
+    :param faces: face rectangles(dlib.rectangle) from another detector, the detector is skipped if given
+    :return: x_min, x_max, y_min, y_max, size and the 20 mouth landmarks [(x,y), ...] of the face
+    '''
     x_min = None
     x_max = None
     y_min = None
     y_max = None
     size = None
+    points = None
 
     img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    faces = detector(img_rgb, 0)
+    if faces is None:
+        faces = detector(img_rgb, 0)
     #print("len of faces = ",len(faces))
     if len(faces):
         for coor in (faces):#coordinate format:[(left,top), (right,bottom)]
@@ -34,19 +224,322 @@ def detect_mouth(img,detector,predictor):
             x_min = np.maximum(min(x) - width // 3, 0)
 
             size = ((x_max-x_min),(y_max-y_min))#(width,height)
+            points = list(zip(x, y))
+
+    return x_min, x_max, y_min, y_max, size, points
+
+
+def detect_mouth(img,detector,predictor,faces=None):
+    '''
+    :param faces: face rectangles(dlib.rectangle) from another detector, the detector is skipped if given
+    '''
+
+    return detect_mouth_points(img, detector, predictor, faces=faces)[:5]
+
+
+def template_mouth(img_shape,template):
+    '''
+    the mouth part of an aligned crop from the fixed normalized coordinates, no detection
+    :param img_shape: shape of the crop
+    :param template: normalized (x_min, y_min, x_max, y_max) of the mouth part
+    :return: x_min, y_min, size
+    '''
+    height, width = img_shape[:2]
+    x_min = int(template[0] * width)
+    y_min = int(template[1] * height)
+    x_max = min(int(round(template[2] * width)), width)
+    y_max = min(int(round(template[3] * height)), height)
+
+    return x_min, y_min, (x_max - x_min, y_max - y_min)
+
+
+def template_check_iou(img,predictor,x_min,y_min,size):
+    '''
+    cheap sanity check of the template mouth part: the landmarks of the whole crop(shape predictor only,
+    no face detection) give the other mouth part
+    :return: IoU of the 2 mouth parts
+    '''
+    height, width = img.shape[:2]
+    l_x_min, l_x_max, l_y_min, l_y_max, l_size = detect_mouth(img, None, predictor,
+                                                              faces=[dlib.rectangle(0, 0, width - 1, height - 1)])
+    if l_size is None:
+        return 0
+    inter_w = max(0, min(x_min + size[0], l_x_max) - max(x_min, l_x_min))
+    inter_h = max(0, min(y_min + size[1], l_y_max) - max(y_min, l_y_min))
+    inter = inter_w * inter_h
+    union = size[0] * size[1] + l_size[0] * l_size[1] - inter
+
+    return inter / max(union, 1)
+
+
+def composite(roi,layer,mask,alpha=None):
+    '''
+    put the layer on the ROI in place, without the temporary images of cv2 bitwise_and, bitwise_not and add.
+    The binary way gives the same result as roi & ~mask + layer & mask.
+    A batch of same-size ROIs(e.g. imgs[:, y0:y1, x0:x1]) is done at once, the layer and mask can be shared
+    by the batch or have the batch axis too
+    :param roi: uint8, [h,w,3] or [N,h,w,3], a view of the image is modified
+    :param layer: uint8, [h,w,3] or [N,h,w,3]
+    :param mask: uint8(0 or 255), [h,w] or [N,h,w], the layer pixels
+    :param alpha: uint8, [h,w,1] or [N,h,w,1]. If given, the layer is alpha blended instead(mask is unused)
+    :return: roi
+    '''
+    if alpha is not None:
+        blend = np.subtract(layer, roi, dtype=np.int32)
+        blend *= alpha
+        blend += 127
+        blend //= 255
+        blend += roi
+        np.copyto(roi, blend, casting='unsafe')
+    elif roi.ndim == 3:
+        cv2.copyTo(layer, mask, roi)#the ROI view is written in place
+    else:
+        #----cv2.copyTo of each ROI is faster than numpy bitwise ops broadcast on the batch
+        for i in range(roi.shape[0]):
+            cv2.copyTo(layer if layer.ndim == 3 else layer[i], mask if mask.ndim == 2 else mask[i], roi[i])
+
+    return roi
+
+
+def wear_mask(img,x_min,y_min,size,mask_cache,which,alpha=False):
+    '''
+    put the face mask on the mouth part, the face mask is centered in the mouth part when its size is quantized
+    :param img: BGR image [H,W,3], or same-size images [N,H,W,3] with the same mouth part, modified in place
+    :param x_min, y_min: top left of the mouth part
+    :param size: (width,height) of the mouth part
+    :param mask_cache: MaskAssetCache
+    :param which: index of the face mask
+    :param alpha: True to blend with the alpha channel(soft edges) instead of the binary mask
+    :return: img
+    '''
+    img_item, item_mask, item_img_bgr, item_alpha = mask_cache.get(which, size)
+    q_width, q_height = item_mask.shape[1], item_mask.shape[0]
+    x_min += (size[0] - q_width) // 2
+    y_min += (size[1] - q_height) // 2
+
+    roi = img[..., y_min:y_min + q_height, x_min:x_min + q_width, :]
+    if alpha is True:
+        composite(roi, item_img_bgr, item_mask, alpha=item_alpha)
+    else:
+        composite(roi, img_item, item_mask)
+
+    return img
+
+
+#----worker process vars, set by mask_worker_init
+worker_vars = dict()
 
-    return x_min, x_max, y_min, y_max, size
 
+def mask_choice(seed_key,seed,len_mask,variants=1):
+    '''
+    the face mask choices of an image only depend on seed and seed_key, not on the processing order or worker number
+    :param seed_key: "class name/file name" of the image
+    :param seed: int
+    :param len_mask: number of face masks
+    :param variants: number of face masks of the image, they are different if len_mask is enough
+    :return: list of face mask indexes, the first one is the same whatever variants is
+    '''
+    rng = random.Random(zlib.crc32(seed_key.encode("utf-8")) ^ seed)
+    whiches = [rng.randint(0, len_mask - 1)]
+    if variants > 1:
+        others = [which for which in range(len_mask) if which != whiches[0]]
+        if variants - 1 <= len(others):
+            whiches.extend(rng.sample(others, variants - 1))
+        else:
+            whiches.extend([rng.randint(0, len_mask - 1) for _ in range(variants - 1)])
+
+    return whiches
+
+
+def variant_filenames(new_dir,filename,variants=1):
+    '''
+    :return: list of save paths, the first one keeps filename, the others are named like name_mask1.jpg
+    '''
+    name, ext = os.path.splitext(filename)
+    new_filenames = [os.path.join(new_dir, filename)]
+    for k in range(1, variants):
+        new_filenames.append(os.path.join(new_dir, "{}_mask{}{}".format(name, k, ext)))
+
+    return new_filenames
+
+
+def fmd_face_rects(fmd,imgs):
+    '''
+    face rectangles of a batch of images from FaceMaskDetection(one session run), the most confident face is kept
+    :param fmd: FaceMaskDetection
+    :param imgs: list of BGR images
+    :return: list of face rectangle lists, for detect_mouth
+    '''
+    # ----var
+    faces_list = list()
+
+    img_4d = np.stack([fmd.img_preprocess(img) for img in imgs])
+    results = fmd.inference_batch(img_4d, [img.shape[:2] for img in imgs])
+    for re_boxes, re_confidence, re_classes, re_mask_id in results:
+        if len(re_boxes) == 0:
+            faces_list.append([])
+        else:
+            x, y, w, h = re_boxes[int(np.argmax(re_confidence))]
+            faces_list.append([dlib.rectangle(int(x), int(y), int(x + w), int(y + h))])
+
+    return faces_list
 
-def mask_wearing(root_dir,output_dir=None,dataset_range=None):
+
+def mask_one(path,new_filenames,whiches,detector,predictor,mask_cache,img=None,faces=None,mouth=None,template=None,
+             template_check=None):
+    '''
+    mouth detection, wear the face masks and save the images(one image for each face mask)
+    :param img: the image of path if it's already read
+    :param faces: face rectangles of the image, see detect_mouth
+    :param mouth: cached (x_min, y_min, size) of the image, the detection is skipped if given
+    :param template: normalized mouth part of aligned crops, see template_mouth. The detection is skipped if given
+    :param template_check: IoU threshold of template_check_iou, the image is skipped below it. None: no check
+    :return: number of saved images, (x_min, y_min, size, points) if the detection is run else None
+    '''
+    # ----var
+    record = None
+    save_count = 0
+
+    if img is None:
+        img = cv2.imread(path)
+    if img is None:
+        print("read failed:{}".format(path))
+        return save_count, record
+
+    if template is not None:
+        x_min, y_min, size = template_mouth(img.shape, template)
+        if template_check is not None and template_check_iou(img, predictor, x_min, y_min, size) < template_check:
+            print("template check failed:{}".format(path))
+            return save_count, record
+    elif mouth is None:
+        x_min, x_max, y_min, y_max, size, points = detect_mouth_points(img, detector, predictor, faces=faces)
+        record = (x_min, y_min, size, points)
+    else:
+        x_min, y_min, size = mouth
+    if size is None or size[0] <= 0 or size[1] <= 0:#landmarks can lie outside the image
+        return save_count, record
+
+    for i, (new_filename, which) in enumerate(zip(new_filenames, whiches)):
+        # ----face mask process
+        img_mask = img if i == len(whiches) - 1 else img.copy()
+        wear_mask(img_mask, x_min, y_min, size, mask_cache, which)
+
+        # -----save img
+        cv2.imwrite(new_filename, img_mask)
+        save_count += 1
+
+    return save_count, record
+
+
+def mask_worker_init(mask_img_dir,predictor_path,size_step,max_variants,template=None,template_check=None):
+    '''
+    load dlib models and face masks once per worker process
+    '''
+    worker_vars['detector'] = dlib.get_frontal_face_detector() if template is None else None
+    worker_vars['predictor'] = None
+    if template is None or template_check is not None:
+        worker_vars['predictor'] = dlib.shape_predictor(predictor_path)
+    worker_vars['mask_cache'] = MaskAssetCache(mask_img_dir, size_step=size_step, max_variants=max_variants)
+    worker_vars['template'] = template
+    worker_vars['template_check'] = template_check
+
+
+def mask_worker(tasks):
+    '''
+    :param tasks: list of (path, new_filenames, whiches, mtime, mouth)
+    :return: number of saved images, list of (path, mtime, record) of the detected images
+    '''
+    count = 0
+    records = list()
+    for path, new_filenames, whiches, mtime, mouth in tasks:
+        save_count, record = mask_one(path, new_filenames, whiches, worker_vars['detector'], worker_vars['predictor'],
+                                      worker_vars['mask_cache'], mouth=mouth, template=worker_vars['template'],
+                                      template_check=worker_vars['template_check'])
+        count += save_count
+        if record is not None:
+            records.append((path, mtime, record))
+
+    return count, records
+
+
+def mask_wearing_fmd(tasks,mask_cache,predictor_path,pb_path,batch_size=16,GPU_ratio=None,landmark_cache=None):
+    '''
+    face rectangles from FaceMaskDetection go straight to the shape predictor, no dlib HOG detection
+    :param tasks: list of (path, new_filenames, whiches, mtime, mouth)
+    :param landmark_cache: LandmarkCache, the detected mouth parts are added
+    :return: number of saved images
+    '''
+    # ----var
+    save_count = 0
+
+    # ----images with the cached mouth part, no model is needed
+    for path, new_filenames, whiches, mtime, mouth in tasks:
+        if mouth is not None:
+            save_count += mask_one(path, new_filenames, whiches, None, None, mask_cache, mouth=mouth)[0]
+    tasks = [task for task in tasks if task[4] is None]
+    if len(tasks) == 0:
+        return save_count
+
+    # ----the models are loaded only for the images to be detected
+    from face_alignment import FaceMaskDetection#tensorflow is only loaded in this mode
+    fmd = FaceMaskDetection(pb_path, margin=0, GPU_ratio=GPU_ratio)
+    predictor = dlib.shape_predictor(predictor_path)
+
+    for i in range(0, len(tasks), batch_size):
+        # ----read a batch
+        batch_tasks = list()
+        imgs = list()
+        for task in tasks[i:i + batch_size]:
+            img = cv2.imread(task[0])
+            if img is None:
+                print("read failed:{}".format(task[0]))
+            else:
+                batch_tasks.append(task)
+                imgs.append(img)
+
+        if len(imgs) > 0:
+            faces_list = fmd_face_rects(fmd, imgs)
+            for (path, new_filenames, whiches, mtime, mouth), img, faces in zip(batch_tasks, imgs, faces_list):
+                count, record = mask_one(path, new_filenames, whiches, None, predictor, mask_cache, img=img,
+                                         faces=faces)
+                save_count += count
+                if landmark_cache is not None:
+                    landmark_cache.add(path, mtime, *record)
+
+    return save_count
+
+
+def mask_wearing(root_dir,output_dir=None,dataset_range=None,mask_img_dir=".\mask_img",size_step=8,max_variants=256,
+                 predictor_path='src/models/shape_predictor_68_face_landmarks.dat',workers=1,chunk_size=64,seed=None,
+                 pb_path=None,batch_size=16,GPU_ratio=None,landmark_dir=None,variants=1,template=None,
+                 template_check=None):
+    '''
+    :param pb_path: face mask detection pb file. If given, the face rectangles come from FaceMaskDetection(batched)
+                    instead of the dlib HOG detector, and the images are processed in this process(workers is unused)
+    :param batch_size: images of each FaceMaskDetection run
+    :param GPU_ratio: GPU memory ratio of FaceMaskDetection
+    :param workers: number of worker processes, each one loads its own dlib models. 1 means no worker process
+    :param chunk_size: images of each worker task
+    :param seed: seed of the face mask choices, random if None.
+                 Each image gets the same face mask whatever the worker number is.
+    :param landmark_dir: dir of LandmarkCache. The images cached with the same mtime skip the detection
+    :param variants: number of masked images of each face, each one with a different face mask
+    :param template: for the crops of img_alignment, normalized (x_min, y_min, x_max, y_max) of the mouth part,
+                     e.g. (0.12,0.48,0.88,0.98). No face detection and landmarks(pb_path and landmark_dir are unused)
+    :param template_check: IoU threshold of the landmarks check of the template mouth part(shape predictor only),
+                           None means no check
+    '''
     # ----var
-    mask_img_dir = ".\mask_img"
     img_format = {'png','jpg'}
-    paths = list()
-    detect_flag = False
-    # ----read mask png images
-    mask_files = [file.path for file in os.scandir(mask_img_dir) if file.name.split(".")[-1] == 'png']
-    len_mask = len(mask_files)
+    tasks = list()
+    save_count = 0
+    cached_count = 0
+    landmark_cache = None
+    # ----read mask png images once
+    mask_cache = MaskAssetCache(mask_img_dir, size_step=size_step, max_variants=max_variants)
+    len_mask = mask_cache.mask_num
+    if seed is None:
+        seed = random.randint(0, 2 ** 31 - 1)
     if len_mask == 0:
         print("Error: no face mask PNG images in  ", mask_img_dir)
     else:
@@ -65,73 +558,70 @@ def mask_wearing(root_dir,output_dir=None,dataset_range=None):
             else:
                 print("Working classes:All")
 
-            # ----collect all image paths from all sub-folders
+            # ----create dir for img
+            if output_dir is None:
+                output_dir = os.path.join(root_dir, "img_wear_mask")
+            if landmark_dir is not None and template is None:
+                landmark_cache = LandmarkCache(landmark_dir)
+
+            # ----collect all image paths from all sub-folders, create save_dir for each sub dir
             for dir_path in dirs:
-                files_temp = [file.path for file in os.scandir(dir_path) if file.name.split(".")[-1] in img_format]
+                files_temp = [file for file in os.scandir(dir_path) if file.name.split(".")[-1] in img_format]
                 if len(files_temp) == 0:
                     print("no files under {}".format(dir_path))
                 else:
-                    paths.extend(files_temp)
-
-            if len(paths) > 0:
-                detect_flag = True
-
-            # ----execution if detect_flag is True
-            if detect_flag is True:
-                # ----create dir for img
-                if output_dir is None:
-                    output_dir = os.path.join(root_dir, "img_wear_mask")
-                if not os.path.exists(output_dir):
-                    os.makedirs(output_dir)
-
-                # ----create save_dir for each sub dir
-                sub_dir_dict = dict()
-                for dir_path in dirs:
                     dir_name = dir_path.split("\\")[-1]
                     new_dir = os.path.join(output_dir, dir_name)
                     if not os.path.exists(new_dir):
                         os.makedirs(new_dir)
-                    sub_dir_dict[dir_name] = new_dir
-                # ----face detection init
-                detector = dlib.get_frontal_face_detector()
-                predictor = dlib.shape_predictor('src/models/shape_predictor_68_face_landmarks.dat')
-
-                # ----mouth detection and wear mask on faces
-                for path in paths:
-                    img = cv2.imread(path)
-                    if img is None:
-                        print("read failed:{}".format(path))
-                    else:
-                        x_min, x_max, y_min, y_max, size = detect_mouth(img, detector, predictor)
-                        if size is not None:
-                            # ----random selection of face mask
-                            which = random.randint(0, len_mask - 1)
-                            item_name = mask_files[which]
-
-                            # ----face mask process
-                            item_img = cv2.imread(item_name, cv2.IMREAD_UNCHANGED)
-                            item_img = cv2.resize(item_img, size)
-                            item_img_bgr = item_img[:, :, :3]
-                            item_alpha_ch = item_img[:, :, 3]
-                            _, item_mask = cv2.threshold(item_alpha_ch, 220, 255, cv2.THRESH_BINARY)
-                            img_item = cv2.bitwise_and(item_img_bgr, item_img_bgr, mask=item_mask)
-
-                            # ----mouth part process
-                            roi = img[y_min:y_min + size[1], x_min:x_min + size[0]]
-                            item_mask_inv = cv2.bitwise_not(item_mask)
-                            roi = cv2.bitwise_and(roi, roi, mask=item_mask_inv)
-
-                            # ----addition of mouth and face mask
-                            dst = cv2.add(roi, img_item)
-                            img[y_min: y_min + size[1], x_min:x_min + size[0]] = dst
-
-                            # -----save img
-                            splits = path.split("\\")
-                            new_filename = os.path.join(sub_dir_dict[splits[-2]], splits[-1])
-                            cv2.imwrite(new_filename, img)
-
-
-    print("It's done")
+                    for file in files_temp:
+                        whiches = mask_choice(dir_name + "/" + file.name, seed, len_mask, variants=variants)
+                        new_filenames = variant_filenames(new_dir, file.name, variants=variants)
+                        mtime = file.stat().st_mtime_ns
+                        mouth = None
+                        if landmark_cache is not None:
+                            mouth = landmark_cache.get(file.path, mtime)
+                            if mouth is not None:
+                                cached_count += 1
+                        tasks.append((file.path, new_filenames, whiches, mtime, mouth))
+
+            # ----mouth detection and wear mask on faces
+            if len(tasks) > 0:
+                print("Image number:{}, cached:{}, variants:{}, workers:{}, seed:{}, template:{}".format(
+                    len(tasks), cached_count, variants, workers, seed, template))
+                if pb_path is not None and template is None:
+                    save_count = mask_wearing_fmd(tasks, mask_cache, predictor_path, pb_path, batch_size, GPU_ratio,
+                                                  landmark_cache=landmark_cache)
+                elif workers > 1:
+                    chunks = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+                    with multiprocessing.Pool(workers, initializer=mask_worker_init,
+                                              initargs=(mask_img_dir, predictor_path, size_step, max_variants,
+                                                        template, template_check)) as pool:
+                        for count, records in pool.imap_unordered(mask_worker, chunks):
+                            save_count += count
+                            if landmark_cache is not None:
+                                for path, mtime, record in records:
+                                    landmark_cache.add(path, mtime, *record)
+                else:
+                    # ----face detection init
+                    detector = None
+                    predictor = None
+                    if template is not None and template_check is not None:
+                        predictor = dlib.shape_predictor(predictor_path)
+                    for path, new_filenames, whiches, mtime, mouth in tasks:
+                        if mouth is None and detector is None and template is None:
+                            detector = dlib.get_frontal_face_detector()
+                            predictor = dlib.shape_predictor(predictor_path)
+                        count, record = mask_one(path, new_filenames, whiches, detector, predictor, mask_cache,
+                                                 mouth=mouth, template=template, template_check=template_check)
+                        save_count += count
+                        if landmark_cache is not None and record is not None:
+                            landmark_cache.add(path, mtime, *record)
+
+            if landmark_cache is not None:
+                landmark_cache.close()
+
+    print("It's done, {} images saved".format(save_count))
 
 
 
@@ -139,4 +629,19 @@ if __name__ == "__main__":
     root_dir = r"C:\Users\aarya\Downloads\CASIA-WebFace\cropped faces"
     output_dir = r"C:\Users\aarya\Downloads\CASIA-WebFace\cropped faces mask"
     dataset_range = [0,1997]
-    mask_wearing(root_dir,output_dir=output_dir,dataset_range=dataset_range)
\ No newline at end of file
+    workers = 4#dlib HOG detection is single-threaded, use one worker process per core
+    seed = 0
+    mask_wearing(root_dir,output_dir=output_dir,dataset_range=dataset_range,workers=workers,seed=seed)
+
+    #----face rectangles from FaceMaskDetection instead of the dlib HOG detector
+    # pb_path = r"face_mask_detection.pb"
+    # mask_wearing(root_dir,output_dir=output_dir,dataset_range=dataset_range,seed=seed,pb_path=pb_path,batch_size=32)
+
+    #----cache the mouth parts, the later runs(other seeds or face masks) only blend and save. 3 masked images per face
+    # landmark_dir = r"C:\Users\aarya\Downloads\CASIA-WebFace\landmark cache"
+    # mask_wearing(root_dir,output_dir=output_dir,dataset_range=dataset_range,workers=workers,seed=seed,
+    #              landmark_dir=landmark_dir,variants=3)
+
+    #----crops of img_alignment: the mouth part from the fixed template, no detection
+    # mask_wearing(root_dir,output_dir=output_dir,dataset_range=dataset_range,workers=workers,seed=seed,
+    #              template=(0.12,0.48,0.88,0.98),template_check=None)
\ No newline at end of file
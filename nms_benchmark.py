@@ -0,0 +1,63 @@
+import time
+import numpy as np
+from face_alignment import FaceMaskDetection
+
+
+def nms_benchmark(pb_path,conf_thresh_list=(0.8,0.5,0.2,0.05),iou_thresh=0.7,batch_size=8,repeat=5,pre_top_k=400,
+                  GPU_ratio=None):
+    '''
+    compare single_class_non_max_suppression with fast_non_max_suppression on the decoded output of all the anchors
+    :param pb_path: face mask detection pb file, only used to get the anchors
+    :param conf_thresh_list: the lower conf_thresh, the more anchors take part in NMS
+    :param iou_thresh:
+    :param batch_size: images of each run
+    :param repeat: runs of each conf_thresh
+    :param pre_top_k: the bound of fast NMS in the top-k run
+    :param GPU_ratio:
+    :return:
+    '''
+    # ----var
+    rng = np.random.RandomState(0)
+
+    fmd = FaceMaskDetection(pb_path, GPU_ratio=GPU_ratio)
+    anchor_num = fmd.anchors_exp.shape[1]
+    print("anchor number:", anchor_num)
+
+    # ----fake model outputs of a batch
+    raw_outputs = rng.normal(0, 1, [batch_size, anchor_num, 4]).astype(np.float32)
+    y_bboxes = fmd.decode_bbox(fmd.anchors_exp, raw_outputs)
+    scores = rng.uniform(0, 1, [batch_size, anchor_num]).astype(np.float32)
+
+    for conf_thresh in conf_thresh_list:
+        candidates = np.sum(scores > conf_thresh) / batch_size
+
+        # ----original NMS
+        d_t = time.time()
+        for _ in range(repeat):
+            picks_ori = [fmd.single_class_non_max_suppression(y_bboxes[i], scores[i], conf_thresh=conf_thresh,
+                                                              iou_thresh=iou_thresh) for i in range(batch_size)]
+        d_t_ori = (time.time() - d_t) / (repeat * batch_size)
+
+        # ----fast NMS
+        d_t = time.time()
+        for _ in range(repeat):
+            picks_fast = fmd.fast_non_max_suppression(y_bboxes, scores, conf_thresh=conf_thresh, iou_thresh=iou_thresh)
+        d_t_fast = (time.time() - d_t) / (repeat * batch_size)
+
+        # ----fast NMS bounded by pre_top_k
+        d_t = time.time()
+        for _ in range(repeat):
+            fmd.fast_non_max_suppression(y_bboxes, scores, conf_thresh=conf_thresh, iou_thresh=iou_thresh,
+                                         pre_top_k=pre_top_k)
+        d_t_top_k = (time.time() - d_t) / (repeat * batch_size)
+
+        same = all([np.array_equal(p_ori, p_fast) for p_ori, p_fast in zip(picks_ori, picks_fast)])
+        print("conf_thresh:{}, candidates:{}, ori time:{:.6f}s, fast time:{:.6f}s, speedup:{:.2f}, same picks:{}, "
+              "top-{} time:{:.6f}s".format(conf_thresh, candidates, d_t_ori, d_t_fast, d_t_ori / d_t_fast, same,
+                                           pre_top_k, d_t_top_k))
+
+
+
+if __name__ == "__main__":
+    pb_path = r'face_mask_detection.pb'
+    nms_benchmark(pb_path, conf_thresh_list=(0.8,0.5,0.2,0.05), iou_thresh=0.7, batch_size=8, repeat=5, pre_top_k=400)
@@ -1,48 +1,16 @@
-import os,math,cv2,shutil
+import os,math,shutil,json
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import tensorflow
-
-if tensorflow.__version__.startswith('1.'):
-    import tensorflow as tf
-    from tensorflow.python.platform import gfile
-else:
-    import tensorflow.compat.v1 as tf
-    tf.disable_v2_behavior()
-    import tensorflow.compat.v1.gfile as gfile
-
-print("Tensorflow version: ",tf.__version__)
+from image_check import read_header
+from embedding_engine import EmbeddingEngine
 
 img_format = {'png','jpg','bmp'}
+census_version = 1
 
-def model_restore_from_pb(pb_path, node_dict,GPU_ratio=None):
-    tf_dict = dict()
-    with tf.Graph().as_default():
-        config = tf.ConfigProto(log_device_placement=True,  #print out that CPU or GPU is adopted.
-                                allow_soft_placement=True,  #If no GPU, CPU will be adopted
-                                )
-        if GPU_ratio is None:
-            config.gpu_options.allow_growth = True  # Allow the program to access as much GPU resource as possible
-        else:
-            config.gpu_options.per_process_gpu_memory_fraction = GPU_ratio  #Set the GPU resource ratio manually
-        sess = tf.Session(config=config)
-        with gfile.FastGFile(pb_path, 'rb') as f:
-            graph_def = tf.GraphDef()
-            graph_def.ParseFromString(f.read())
-            sess.graph.as_default()
-            tf.import_graph_def(graph_def, name='')
-        sess.run(tf.global_variables_initializer())
-        for key, value in node_dict.items():
-            try:
-                node = sess.graph.get_tensor_by_name(value)
-                tf_dict[key] = node
-            except:
-                print("node:{} does not exist in the graph".format(key))
-        return sess, tf_dict
-
-def img_removal_by_embed(root_dir,output_dir,pb_path,node_dict,threshold=0.7,type='move',GPU_ratio=None, dataset_range=None):
+def img_removal_by_embed(root_dir,output_dir,pb_path,node_dict,threshold=0.7,type='move',GPU_ratio=None, dataset_range=None,
+                         batch_size=64,cache_dir=None):
     # ----var
     img_format = {"png", 'jpg', 'bmp'}
-    batch_size = 64
 
     # ----collect all folders
     dirs = [obj.path for obj in os.scandir(root_dir) if obj.is_dir()]
@@ -54,122 +22,177 @@ def img_removal_by_embed(root_dir,output_dir,pb_path,node_dict,threshold=0.7,typ
             dirs = dirs[dataset_range[0]:dataset_range[1]]
 
         # ----model init
-        sess, tf_dict = model_restore_from_pb(pb_path, node_dict, GPU_ratio=GPU_ratio)
-        tf_input = tf_dict['input']
-        tf_embeddings = tf_dict['embeddings']
-
-        #----get the model shape
-        if tf_input.shape[1].value is None:
-            model_shape = (None, 160, 160, 3)
-        else:
-            model_shape = (None, tf_input.shape[1].value, tf_input.shape[2].value, 3)
-        print("The mode shape of face recognition:", model_shape)
-
-        # ----set the feed_dict
-        feed_dict = dict()
-        if 'keep_prob' in tf_dict.keys():
-            tf_keep_prob = tf_dict['keep_prob']
-            feed_dict[tf_keep_prob] = 1.0
-        if 'phase_train' in tf_dict.keys():
-            tf_phase_train = tf_dict['phase_train']
-            feed_dict[tf_phase_train] = False
-
-        # ----tf setting for calculating distance
-        with tf.Graph().as_default():
-            tf_tar = tf.placeholder(dtype=tf.float32, shape=tf_embeddings.shape[-1])
-            tf_ref = tf.placeholder(dtype=tf.float32, shape=tf_embeddings.shape)
-            tf_dis = tf.sqrt(tf.reduce_sum(tf.square(tf.subtract(tf_ref, tf_tar)), axis=1))
-            # ----GPU setting
-            config = tf.ConfigProto(log_device_placement=True,
-                                    allow_soft_placement=True,  # 允許當找不到設備時自動轉換成有支援的設備
-                                    )
-            config.gpu_options.allow_growth = True
-            sess_cal = tf.Session(config=config)
-            sess_cal.run(tf.global_variables_initializer())
-
-
-
-        #----process each folder
+        engine = EmbeddingEngine(pb_path, node_dict, GPU_ratio=GPU_ratio, batch_size=batch_size, cache_dir=cache_dir)
+
+        # ----collect the images of all folders, the batches span folders
+        paths = list()
+        classes = list()#(dir_path, save_dir, path start, path end)
         for dir_path in dirs:
-            paths = [file.path for file in os.scandir(dir_path) if file.name.split(".")[-1] in img_format]
-            len_path = len(paths)
-            if len_path == 0:
+            paths_temp = [file.path for file in os.scandir(dir_path) if file.name.split(".")[-1] in img_format]
+            if len(paths_temp) == 0:
                 print("No images in ",dir_path)
             else:
                 # ----create the sub folder in the output folder
                 save_dir = os.path.join(output_dir, dir_path.split("\\")[-1])
                 if not os.path.exists(save_dir):
                     os.makedirs(save_dir)
-                # ----calculate embeddings
-                ites = math.ceil(len_path / batch_size)
-                embeddings = np.zeros([len_path, tf_embeddings.shape[-1]], dtype=np.float32)
-                for idx in range(ites):
-                    num_start = idx * batch_size
-                    num_end = np.minimum(num_start + batch_size, len_path)
-                    # ----read batch data
-                    batch_dim = [num_end - num_start]#[64]
-                    batch_dim.extend(model_shape[1:])#[64,160, 160, 3]
-                    batch_data = np.zeros(batch_dim, dtype=np.float32)
-                    for idx_path,path in enumerate(paths[num_start:num_end]):
-                        img = cv2.imread(path)
-                        if img is None:
-                            print("Read failed:",path)
-                        else:
-                            img = cv2.resize(img, (model_shape[2], model_shape[1]))
-                            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                            batch_data[idx_path] = img
-                    batch_data /= 255  # norm
-                    feed_dict[tf_input] = batch_data
-                    embeddings[num_start:num_end] = sess.run(tf_embeddings, feed_dict=feed_dict)
-
-                # ----calculate ave distance of each image
-                feed_dict_2 = {tf_ref: embeddings}
-                ave_dis = np.zeros(embeddings.shape[0], dtype=np.float32)
-                for idx, embedding in enumerate(embeddings):
-                    feed_dict_2[tf_tar] = embedding
-                    distance = sess_cal.run(tf_dis, feed_dict=feed_dict_2)
-                    ave_dis[idx] = np.sum(distance) / (embeddings.shape[0] - 1)
+                classes.append((dir_path, save_dir, len(paths), len(paths) + len(paths_temp)))
+                paths.extend(paths_temp)
+
+        # ----calculate embeddings, each folder is processed once all its embeddings are ready
+        embeddings = np.zeros([0, engine.embed_length], dtype=np.float32)#embeddings of the unprocessed folders
+        embed_start = 0#path index of embeddings[0]
+        class_idx = 0
+        for num_start, num_end, embed_batch in engine.embed_iter(paths):
+            embeddings = np.concatenate([embeddings, embed_batch], axis=0)
+
+            # ----process the folders whose embeddings are all ready
+            while class_idx < len(classes) and classes[class_idx][3] <= num_end:
+                dir_path, save_dir, path_start, path_end = classes[class_idx]
+                ave_dis = ave_distances(embeddings[path_start - embed_start:path_end - embed_start])
                 # ----remove or copy images
-                for idx,path in enumerate(paths):
-                    if ave_dis[idx] > threshold:
-                        print("path:{}, ave_distance:{}".format(path,ave_dis[idx]))
+                for idx_path,path in enumerate(paths[path_start:path_end]):
+                    if ave_dis[idx_path] > threshold:
+                        print("path:{}, ave_distance:{}".format(path,ave_dis[idx_path]))
                         if type == "copy":
                             save_path = os.path.join(save_dir,path.split("\\")[-1])
                             shutil.copy(path,save_path)
                         elif type == "move":
                             save_path = os.path.join(save_dir,path.split("\\")[-1])
                             shutil.move(path,save_path)
-
-def check_path_length(root_dir,output_dir,threshold=5):
+                embeddings = embeddings[path_end - embed_start:]
+                embed_start = path_end
+                class_idx += 1
+
+def ave_distances(embeddings):
+    '''
+    average euclidean distance of each embedding to the other ones, all from one Gram matrix
+    :param embeddings: numpy array, [n, embed_length], the embeddings of a class
+    :return: numpy array, [n]
+    '''
+    num = embeddings.shape[0]
+    if num < 2:
+        return np.zeros(num, dtype=np.float32)
+
+    gram = np.dot(embeddings, embeddings.T)
+    sq_norm = np.diag(gram).copy()
+    distance = sq_norm[:, None] + sq_norm[None, :] - 2 * gram#squared distances
+    np.maximum(distance, 0, out=distance)
+    np.fill_diagonal(distance, 0)
+    np.sqrt(distance, out=distance)
+
+    return np.sum(distance, axis=1) / (num - 1)
+
+def census_dir(dir_path):
+    '''
+    :return: image quantity, bytes, resolution histogram(the shorter side, key: power of 2 floor) and image quantity
+             of each format of the dir
+    '''
+    count = 0
+    size = 0
+    res_hist = dict()
+    formats = dict()
+    for file in os.scandir(dir_path):
+        ext = file.name.split(".")[-1]
+        if ext in img_format:
+            count += 1
+            formats[ext] = formats.get(ext, 0) + 1
+            size += file.stat().st_size
+            status, height, width = read_header(file.path)
+            key = "unknown" if height is None else str(2 ** int(math.log2(max(min(height, width), 1))))
+            res_hist[key] = res_hist.get(key, 0) + 1
+
+    return count, size, res_hist, formats
+
+def census_index_path(root_dir):
+    '''
+    default census index: {root_dir}_census.json beside root_dir, so the scanned dataset is never written
+    '''
+    return os.path.normpath(os.path.abspath(root_dir)) + "_census.json"
+
+
+def dataset_census(root_dir,index_path=None,workers=8):
+    '''
+    image quantity, bytes and resolution histogram of each class dir, cached in a JSON index.
+    Only the dirs whose mtime changed(files added, removed or renamed) are scanned again.
+    :param index_path: None: census_index_path(root_dir), outside root_dir
+    :param workers: threads of scanning dirs
+    :return: dict of class name to {'mtime', 'count', 'bytes', 'res_hist', 'formats'}, index_path
+    '''
+    # ----var
+    classes = dict()
+    if index_path is None:
+        index_path = census_index_path(root_dir)
+
+    # ----read the index(the ones of other versions are scanned again)
+    if os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as f:
+            content = json.load(f)
+        if content.get('version') == census_version:
+            classes = content['classes']
+
+    # ----scan the changed dirs
+    dirs = [obj for obj in os.scandir(root_dir) if obj.is_dir()]
+    mtimes = {obj.name: obj.stat().st_mtime_ns for obj in dirs}
+    changed = [obj for obj in dirs if obj.name not in classes or classes[obj.name]['mtime'] != mtimes[obj.name]]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for obj, (count, size, res_hist, formats) in zip(changed,
+                                                         executor.map(census_dir, [obj.path for obj in changed])):
+            classes[obj.name] = {'mtime': mtimes[obj.name], 'count': count, 'bytes': size, 'res_hist': res_hist,
+                                 'formats': formats}
+    classes = {name: classes[name] for name in sorted(mtimes.keys())}#removed dirs are dropped
+    save_census(classes, root_dir, index_path)
+
+    print("census of {}: classes:{}, scanned:{}, images:{}, bytes:{}".format(
+        root_dir, len(classes), len(changed), sum([c['count'] for c in classes.values()]),
+        sum([c['bytes'] for c in classes.values()])))
+
+    return classes, index_path
+
+
+def save_census(classes,root_dir,index_path):
+    '''
+    write the census index, the old index is replaced only after the new one is complete
+    '''
+    temp_path = index_path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': census_version, 'root_dir': root_dir, 'classes': classes}, f)
+    os.replace(temp_path, index_path)
+
+
+def check_path_length(root_dir,output_dir,threshold=5,workers=8):
     # ----var
     img_format = {"png", 'jpg'}
 
-    # ----collect all dirs
-    dirs = [obj.path for obj in os.scandir(root_dir) if obj.is_dir()]
+    # ----image quantity of each dir from the census indexes(beside root_dir and output_dir)
+    classes, _ = dataset_census(root_dir, workers=workers)
+    classes_corre, _ = dataset_census(output_dir, workers=workers)
 
-    if len(dirs) == 0:
+    if len(classes) == 0:
         print("No dirs in ",root_dir)
     else:
         # ----process each dir
-        for dir_path in dirs:
-            leng = len([file.name for file in os.scandir(dir_path) if file.name.split(".")[-1] in img_format])
+        for dir_name, census in classes.items():
+            leng = sum([census['formats'].get(ext, 0) for ext in img_format])
             if leng <= threshold:
-                corresponding_dir = os.path.join(output_dir,dir_path.split("\\")[-1])
-                leng_corre = len([file.name for file in os.scandir(corresponding_dir) if file.name.split(".")[-1] in img_format])
-                print("dir name:{}, quantity of origin:{}, quantity of removal:{}".format(dir_path.split("\\")[-1],leng,leng_corre))
-
-def delete_dir_with_no_img(root_dir):
-    # ----collect all dirs
-    dirs = [obj.path for obj in os.scandir(root_dir) if obj.is_dir()]
-    if len(dirs) == 0:
+                census_corre = classes_corre.get(dir_name, {'formats': {}})
+                leng_corre = sum([census_corre['formats'].get(ext, 0) for ext in img_format])
+                print("dir name:{}, quantity of origin:{}, quantity of removal:{}".format(dir_name,leng,leng_corre))
+
+def delete_dir_with_no_img(root_dir,workers=8):
+    # ----image quantity of each dir from the census index
+    classes, index_path = dataset_census(root_dir, workers=workers)
+    if len(classes) == 0:
         print("No dirs in ",root_dir)
     else:
         # ----process each dir
-        for dir_path in dirs:
-            leng = len([file.name for file in os.scandir(dir_path) if file.name.split(".")[-1] in img_format])
-            if leng == 0:
+        for dir_name in list(classes.keys()):
+            if classes[dir_name]['count'] == 0:
+                dir_path = os.path.join(root_dir, dir_name)
                 shutil.rmtree(dir_path)
+                del classes[dir_name]
                 print("Deleted:",dir_path)
+        save_census(classes, root_dir, index_path)
 
 
 
@@ -196,4 +219,8 @@ if __name__ == "__main__":
     root_dir = r"C:\Users\aarya\Downloads\CASIA-WebFace\cropped faces"
     delete_dir_with_no_img(root_dir)
 
+    # ----dataset census(image quantity, bytes and resolution histogram of each class)
+    # root_dir = r"C:\Users\aarya\Downloads\CASIA-WebFace\cropped faces"
+    # classes, index_path = dataset_census(root_dir, workers=8)
+
 
@@ -1,22 +1,11 @@
-import os,math,cv2
+import os,math
 import numpy as np
-import tensorflow
 from sklearn.model_selection import KFold
 from scipy import interpolate
 from sklearn import metrics
-from six.moves import xrange
+from embedding_engine import EmbeddingEngine
 
 
-#----tensorflow version check
-if tensorflow.__version__.startswith('1.'):
-    import tensorflow as tf
-    from tensorflow.python.platform import gfile
-else:
-    import tensorflow.compat.v1 as tf
-    tf.disable_v2_behavior()
-    import tensorflow.compat.v1.gfile as gfile
-print("Tensorflow version: ",tf.__version__)
-
 def read_pairs(pairs_filename):
     pairs = []
     with open(pairs_filename, 'r') as f:
@@ -53,66 +42,6 @@ def add_extension(path):
         return path +'.png'
     else:
         raise RuntimeError('No file "%s" with extension png or jpg.' % path)
-def model_restore_from_pb(pb_path,node_dict):
-    config = tf.ConfigProto(log_device_placement=True,#印出目前的運算是使用CPU或GPU
-                            allow_soft_placement=True,#當設備不存在時允許tf選擇一个存在且可用的設備來繼續執行程式
-                            )
-    config.gpu_options.allow_growth = True#依照程式執行所需要的資料來自動調整
-    #config.gpu_options.per_process_gpu_memory_fraction = 0.6#手動限制GPU資源的使用
-    sess = tf.Session(config=config)
-    with gfile.FastGFile(pb_path, 'rb') as f:
-        graph_def = tf.GraphDef()
-        graph_def.ParseFromString(f.read())
-        sess.graph.as_default()
-
-        #----issue solution if models with batch norm
-        '''
-        如果是有batch normalzition，或者残差网络层，会出现：
-        ValueError: Input 0 of node InceptionResnetV2/Conv2d_1a_3x3/BatchNorm/cond_1/AssignMovingAvg/Switch was passed 
-        float from InceptionResnetV2/Conv2d_1a_3x3/BatchNorm/moving_mean:0 incompatible with expected float_ref.
-        ref:https://blog.csdn.net/dreamFlyWhere/article/details/83023256
-        '''
-        for node in graph_def.node:
-            if node.op == 'RefSwitch':
-                node.op = 'Switch'
-                for index in xrange(len(node.input)):
-                    if 'moving_' in node.input[index]:
-                        node.input[index] = node.input[index] + '/read'
-            elif node.op == 'AssignSub':
-                node.op = 'Sub'
-                if 'use_locking' in node.attr: del node.attr['use_locking']
-
-        tf.import_graph_def(graph_def, name='')  # 匯入計算圖
-
-    sess.run(tf.global_variables_initializer())
-    for key,value in node_dict.items():
-        node = sess.graph.get_tensor_by_name(value)
-        node_dict[key] = node
-    return sess,node_dict
-
-def get_epoch_data(data_array,start,end,shape):
-    '''
-    :param data_array:
-    :param start:
-    :param end:
-    :param shape: [N,H,W,C]
-    :return:
-    '''
-
-    epoch_data = np.zeros(shape,dtype=float)
-    for i in range(start ,end ,1):
-        img = cv2.imread(data_array[i])
-        if img is not None:
-            img = cv2.cvtColor(img ,cv2.COLOR_BGR2RGB)
-            img = cv2.resize(img ,(shape[2] ,shape[1]))
-            img = img.astype('float32')
-            img = img / 255
-        else:
-            print("{} read failed".format(data_array[i]))
-        epoch_data[i - start] = img
-
-    return epoch_data
-
 
 def evaluate(embeddings, actual_issame, nrof_folds=10, distance_metric=0, subtract_mean=False):
     # Calculate evaluation metrics
@@ -248,7 +177,7 @@ def calculate_val_far(threshold, dist, actual_issame):
     val = float(true_accept) / float(n_same)
     far = float(false_accept) / float(n_diff)
     return val, far
-def eval_on_lfw(lfw_dir,lfw_pairs_path,pb_path,node_dict):
+def eval_on_lfw(lfw_dir,lfw_pairs_path,pb_path,node_dict,cache_dir=None):
     #----local var
     batch_size = 12
 
@@ -260,41 +189,11 @@ def eval_on_lfw(lfw_dir,lfw_pairs_path,pb_path,node_dict):
     paths, actual_issame = get_paths(os.path.expanduser(lfw_dir), pairs)
 
     #----restore the model from pb file
-    sess, node_dict = model_restore_from_pb(pb_path, node_dict)
-    tf_input = node_dict['input']
-    tf_embeddings = node_dict['embeddings']
-
-
-    if "phase_train" in node_dict.keys():
-        tf_phase_train = node_dict['phase_train']
-
-    print("embeddings shape = ",tf_embeddings.shape)
-
-    # model_shape = tf_input.shape
-    # print("model_shape = ",model_shape)
+    engine = EmbeddingEngine(pb_path, node_dict, batch_size=batch_size, cache_dir=cache_dir)
+    print("embeddings shape = ",engine.tf_embeddings.shape)
 
     #----collect all embeddings
-    iterations = math.ceil(len(paths)/batch_size)
-
-    for i in range(iterations):
-        n_start = i * batch_size
-        n_end = n_start + batch_size
-        if n_end > len(paths):
-            n_end = len(paths)
-            n_start = n_end - batch_size
-
-        epoch_data = get_epoch_data(paths, n_start, n_end,
-                                         (n_end - n_start, 160, 160, 3))
-        if "phase_train" in node_dict.keys():
-            feed_dict = {tf_input:epoch_data,tf_phase_train:False}
-        else:
-            feed_dict = {tf_input: epoch_data}
-        sess_out = sess.run(tf_embeddings,feed_dict=feed_dict)
-
-        if i == 0:
-            embeddings = sess_out
-        else:
-            embeddings = np.concatenate((embeddings,sess_out),axis=0)
+    embeddings = engine.embed(paths)
 
     print(embeddings.shape)
     tpr, fpr, accuracy, val, val_std, far = evaluate(embeddings, actual_issame, nrof_folds=10, distance_metric=0, subtract_mean=False)